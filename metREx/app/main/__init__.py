@@ -4,6 +4,7 @@ import traceback
 import warnings
 
 from datetime import datetime, timedelta
+from timeit import default_timer
 
 from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
 from apscheduler.schedulers.base import MaxInstancesReachedError
@@ -16,7 +17,7 @@ from flask_apscheduler import APScheduler
 
 from flask_sqlalchemy import _EngineConnector as _EngineConnectorBase, SQLAlchemy as SQLAlchemyBase
 
-from prometheus_client import generate_latest, Counter, Histogram
+from prometheus_client import generate_latest, Counter, Gauge, Histogram
 from prometheus_client.core import GaugeMetricFamily
 from prometheus_client.utils import INF
 
@@ -24,7 +25,9 @@ from prometheus_flask_exporter import PrometheusMetrics
 
 from pytz_deprecation_shim import PytzUsageWarning
 
+from sqlalchemy import event
 from sqlalchemy.dialects import registry
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from werkzeug.middleware.proxy_fix import ProxyFix
 
@@ -34,13 +37,35 @@ from .api.wavefront import Wavefront
 
 from .config import config_by_name
 
-from .util.prometheus_helper import prometheus_multiproc_dir, get_registry, register_collector, unregister_collector
+from .database import DatabaseAccessLayer, SharedConnections, SharedResults
+
+from .util.asyncio_helper import EventLoopThread
+from .util.mmap_helper import result_store_dir, ResultStore, StoredExposition
+from .util.prometheus_helper import exposition_formats, prometheus_multiproc_dir, choose_exposition_format, get_registry, register_collector, unregister_collector, Exposition
+from .util.sample_helper import TextLineCache
+from .util.sqlalchemy_helper import async_drivers, last_timestamp_default, last_timestamp_param_pattern
 
 
 class _EngineConnector(_EngineConnectorBase):
+    _instrumented_engine = None
+
+    def get_engine(self):
+        engine = super(_EngineConnector, self).get_engine()
+
+        with self._lock:
+            if engine is not self._instrumented_engine:
+                instrument_engine(engine, self._bind)
+
+                self._instrumented_engine = engine
+
+        return engine
+
     def get_options(self, sa_url, echo):
         sa_url, options = super(_EngineConnector, self).get_options(sa_url, echo)
 
+        # Pool settings defined for the service override the defaults
+        options.update(self._app.config.get('SQLALCHEMY_BINDS_ENGINE_OPTIONS', {}).get(self._bind, {}))
+
         if sa_url.drivername.startswith('oracle'):
             warnings.filterwarnings("ignore", ".*max_identifier_length.*")
 
@@ -52,6 +77,10 @@ class _EngineConnector(_EngineConnectorBase):
 
         poolclass = options.get('poolclass')
 
+        if sa_url.get_driver_name() in async_drivers and poolclass and poolclass.__name__ == 'QueuePool':
+            # Connections of async drivers are checked out by coroutines sharing the event loop thread
+            options['poolclass'] = poolclass = AsyncAdaptedQueuePool
+
         if poolclass and poolclass.__name__ in ['NullPool', 'StaticPool']:
             if 'pool_size' in options.keys():
                 options.pop('pool_size')
@@ -59,6 +88,13 @@ class _EngineConnector(_EngineConnectorBase):
             if 'pool_recycle' in options.keys():
                 options.pop('pool_recycle')
 
+        if poolclass and poolclass.__name__ not in ['AsyncAdaptedQueuePool', 'QueuePool']:
+            if 'max_overflow' in options.keys():
+                options.pop('max_overflow')
+
+            if 'pool_timeout' in options.keys():
+                options.pop('pool_timeout')
+
         return sa_url, options
 
 
@@ -91,6 +127,10 @@ custom_dialect_info = {
         'driver': 'ibm_db',
         'objname': 'DB2Dialect'
     },
+    'oracle': {
+        'driver': 'cx_oracle',
+        'objname': 'OracleDialect'
+    },
     'postgresql': {
         'driver': 'pg8000',
         'objname': 'PostgreSQLDialect'
@@ -130,13 +170,179 @@ JOB_FAILURES = Counter(
     registry=app_registry
 )
 
+JOB_EXPOSITION_CACHE = Counter(
+    'metrex_job_exposition_cache_total',
+    'Lookups of pre-rendered metREx job metrics',
+    ['job', 'result'],
+    registry=app_registry
+)
+
+JOB_QUERY_EXECUTIONS_SAVED = Counter(
+    'metrex_job_query_executions_saved_total',
+    'Database queries not executed by metREx job because an identical query of another job had fetched its rows',
+    ['job'],
+    registry=app_registry
+)
+
+JOB_SERVICE_EXECUTION_TIME = Histogram(
+    'metrex_job_service_execution_seconds',
+    'Time spent fetching metREx job metrics from a single source service',
+    ['job', 'service'],
+    registry=app_registry,
+    buckets=(.1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, 10.0, 30.0, 60.0, 150.0, 300.0, INF)
+)
+
+JOB_SERVICE_FAILURES = Counter(
+    'metrex_job_service_failures_total',
+    'Failed fetches of metREx job metrics from a single source service',
+    ['job', 'service', 'exception'],
+    registry=app_registry
+)
+
+JOB_STATEMENT_CACHE = Counter(
+    'metrex_job_statement_cache_total',
+    'Lookups of metREx job statements in the compiled statement cache of the database engine',
+    ['job', 'result'],
+    registry=app_registry
+)
+
+JOB_SERIES = Gauge(
+    'metrex_job_series',
+    'Series currently exposed by metREx job',
+    ['job'],
+    registry=app_registry,
+    multiprocess_mode='max'
+)
+
+JOB_SERIES_DROPPED = Counter(
+    'metrex_job_series_dropped_total',
+    'Series dropped by metREx job for exceeding its series or label value limits',
+    ['job'],
+    registry=app_registry
+)
+
+JOB_SCRAPE_RENDER_TIME = Histogram(
+    'metrex_job_scrape_render_seconds',
+    'Time spent rendering metREx job metrics for a scrape',
+    ['job', 'format'],
+    registry=app_registry,
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, INF)
+)
+
+JOB_SCRAPE_RESPONSE_SIZE = Histogram(
+    'metrex_job_scrape_response_bytes',
+    'Size of metREx job metrics sent for a scrape',
+    ['job', 'format'],
+    registry=app_registry,
+    buckets=(1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864, 268435456, INF)
+)
+
+JOB_SERIES_CHANGED = Gauge(
+    'metrex_job_series_changed',
+    'Series added, updated or removed by the last run of metREx job',
+    ['job'],
+    registry=app_registry,
+    multiprocess_mode='max'
+)
+
+result_store = ResultStore(result_store_dir) if result_store_dir is not None else None
+
+DB_CONNECT_TIME = Histogram(
+    'metrex_db_connect_seconds',
+    'Time spent opening new database connections',
+    ['service'],
+    registry=app_registry,
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, INF)
+)
+
+DB_CONNECT_PHASE_TIME = Histogram(
+    'metrex_db_connect_phase_seconds',
+    'Time spent in each phase of opening new database connections: driver (connecting, including any TLS handshake, and authenticating) or setup (initializing the connection for use)',
+    ['service', 'phase'],
+    registry=app_registry,
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, INF)
+)
+
+DB_POOL_CHECKED_OUT = Gauge(
+    'metrex_db_pool_checked_out_connections',
+    'Database connections currently checked out of the connection pool',
+    ['service'],
+    registry=app_registry,
+    multiprocess_mode='livesum'
+)
+
+DB_POOL_CHECKOUT_TIME = Histogram(
+    'metrex_db_pool_checkout_seconds',
+    'Time spent waiting to check out a database connection, including any time spent connecting',
+    ['service'],
+    registry=app_registry,
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, INF)
+)
+
 registered_collectors = {}
 
+job_expositions = {}
+
+job_text_line_caches = {}
+
+job_row_projectors = {}
+
+job_statements = {}
+
+shared_connections = SharedConnections()
+
+shared_query_results = SharedResults()
+
+event_loop = EventLoopThread('metREx-event-loop')
+
 job_collector_metrics = {}
 
 job_push_service_names = {}
 
 
+def check_job_query_bytes(app, job_list):
+    """Logs the bytes estimated to be processed by each query of BigQuery jobs, rejecting any job whose query would
+    exceed its maximum_bytes_billed."""
+    dal = DatabaseAccessLayer(db)
+
+    binds = app.config.get('SQLALCHEMY_BINDS') or {}
+
+    with app.app_context():
+        for job in job_list:
+            if job['args'][0] != 'database':
+                continue
+
+            job_name = job['id']
+
+            statement = job['args'][3]
+
+            maximum_bytes_billed = job.get('kwargs', {}).get('execution_options', {}).get('maximum_bytes_billed')
+
+            parameters = None
+
+            if last_timestamp_param_pattern.search(statement):
+                # Estimated as for the first run, which queries every row
+                parameters = {
+                    'last_timestamp': last_timestamp_default
+                }
+
+            for service_name in job['args'][2]['source']:
+                if not str(binds.get(service_name, '')).startswith('bigquery'):
+                    continue
+
+                try:
+                    estimated_bytes = dal.get_estimated_bytes(service_name, statement, parameters)
+                except Exception as e:
+                    # A failed estimate, such as during an outage, leaves the job to be limited by BigQuery when run
+                    app.logger.warning("Unable to estimate bytes processed by query of job '" + job_name + "' on database service '" + service_name + "': " + str(e))
+                    continue
+
+                app.logger.info("Query of job '" + job_name + "' estimated to process " + str(estimated_bytes) + " bytes on database service '" + service_name + "'.")
+
+                if maximum_bytes_billed is not None and estimated_bytes > maximum_bytes_billed:
+                    raise ValueError("Query of job '" + job_name + "' estimated to process " + str(estimated_bytes) + " bytes on database service '" + service_name + "', exceeding its maximum of " + str(maximum_bytes_billed) + ".")
+
+
 def create_app(config_name):
     from .. import blueprint
 
@@ -159,6 +365,8 @@ def create_app(config_name):
         with app.app_context():
             config_obj.add_jobs_from_source(aa)
 
+        check_job_query_bytes(app, config_obj.SCHEDULER_JOBS)
+
         app.config.from_object(config_obj)
 
         aps.init_app(app)
@@ -211,14 +419,34 @@ def get_grouping_key(job_name, job_collector_registry):
     return grouping_key
 
 
-def get_jobs():
+def get_jobs(categories=None):
     job_list = aps.app.config.get('SCHEDULER_JOBS')
 
     return [
-        job['id'] for job in job_list
+        job['id'] for job in job_list if not categories or job['args'][0] in categories
     ]
 
 
+def get_job_exposition(job_name):
+    if job_name in job_expositions.keys():
+        JOB_EXPOSITION_CACHE.labels(job_name, 'hit').inc()
+
+        return job_expositions[job_name]
+
+    if result_store is not None:
+        # Written by the scheduler process when serving from another worker process
+        exposition = result_store.read(job_name)
+
+        if exposition is not None:
+            JOB_EXPOSITION_CACHE.labels(job_name, 'hit').inc()
+
+            return exposition
+
+    JOB_EXPOSITION_CACHE.labels(job_name, 'miss').inc()
+
+    return None
+
+
 def get_push_services(job_name, service_names=None):
     push_services = {}
 
@@ -247,6 +475,49 @@ def init_job_metric_counters(job_name, category):
     for e in exceptions:
         JOB_FAILURES.labels(job_name, category, e.__name__)
 
+    JOB_SERIES_DROPPED.labels(job_name)
+
+
+def instrument_engine(engine, bind):
+    service = bind or ''
+
+    def on_do_connect(dialect, connection_record, cargs, cparams):
+        start_time = default_timer()
+
+        connection_record.info['connect_start_time'] = start_time
+
+        # Connected here, so the driver's time can be told apart from the setup run by the other connect listeners
+        dbapi_connection = dialect.connect(*cargs, **cparams)
+
+        connection_record.info['connect_setup_start_time'] = default_timer()
+
+        DB_CONNECT_PHASE_TIME.labels(service, 'driver').observe(connection_record.info['connect_setup_start_time'] - start_time)
+
+        return dbapi_connection
+
+    def on_connect(dbapi_connection, connection_record):
+        end_time = default_timer()
+
+        start_time = connection_record.info.pop('connect_start_time', None)
+        setup_start_time = connection_record.info.pop('connect_setup_start_time', None)
+
+        if start_time is not None:
+            DB_CONNECT_TIME.labels(service).observe(end_time - start_time)
+
+        if setup_start_time is not None:
+            DB_CONNECT_PHASE_TIME.labels(service, 'setup').observe(end_time - setup_start_time)
+
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        DB_POOL_CHECKED_OUT.labels(service).inc()
+
+    def on_checkin(dbapi_connection, connection_record):
+        DB_POOL_CHECKED_OUT.labels(service).dec()
+
+    event.listen(engine, 'do_connect', on_do_connect)
+    event.listen(engine, 'connect', on_connect)
+    event.listen(engine, 'checkout', on_checkout)
+    event.listen(engine, 'checkin', on_checkin)
+
 
 def job_completed_event_listener(event):
     aps.app.logger.info("Job '" + event.job_id + "' completed.")
@@ -332,7 +603,11 @@ def push_wavefront_job_metrics(job_name, services):
                     dal = Wavefront(aa)
                     dal.init_aa(service_name)
 
-                    dal.client.send(source=source, metrics=job_collector_metrics[job_name])
+                    metrics = {
+                        metric_name: samples.to_dict() for metric_name, samples in job_collector_metrics[job_name].items()
+                    }
+
+                    dal.client.send(source=source, metrics=metrics)
 
                 aps.app.logger.info("Sent metrics for job '" + job_name + "' to Wavefront service '" + service + "'.")
             except Exception as e:
@@ -361,6 +636,8 @@ def reload_job(job, run_on_reload=False):
 def set_job_collector_metrics(job_name, collector_metrics, push_services):
     job_collector_metrics[job_name] = collector_metrics
 
+    JOB_SERIES_DROPPED.labels(job_name).inc(getattr(collector_metrics, 'dropped_series_count', 0))
+
     if job_name not in registered_collectors.keys():
         use_timestamp = len(push_services) == 0
 
@@ -368,6 +645,41 @@ def set_job_collector_metrics(job_name, collector_metrics, push_services):
 
         register_collector(job_name, registered_collectors[job_name])
 
+    job_collector = JobCollector(job_name, registered_collectors[job_name].use_timestamp, collector_metrics)
+
+    series_count = sum([len(samples) for samples in collector_metrics.values()])
+
+    JOB_SERIES.labels(job_name).set(series_count)
+
+    streaming_min_series = aps.app.config.get('EXPOSITION_STREAMING_MIN_SERIES')
+
+    if streaming_min_series and series_count >= streaming_min_series:
+        # Too large to hold rendered in memory; rendered in chunks on each scrape instead
+        job_expositions[job_name] = Exposition(job_collector, streaming=True)
+
+        if job_name in job_text_line_caches.keys():
+            del job_text_line_caches[job_name]
+    else:
+        if job_name not in job_text_line_caches.keys():
+            job_text_line_caches[job_name] = TextLineCache()
+
+        # Render once per job run, re-rendering only the series changed since the last run
+        data, changed_count = job_text_line_caches[job_name].render(collector_metrics, job_collector.use_timestamp)
+
+        JOB_SERIES_CHANGED.labels(job_name).set(changed_count)
+
+        job_expositions[job_name] = Exposition(job_collector, data={
+            'text': data
+        })
+
+    if result_store is not None:
+        if job_expositions[job_name].streaming:
+            chunks = job_collector.generate_text_chunks(aps.app.config.get('EXPOSITION_CHUNK_SIZE'))
+        else:
+            chunks = [job_expositions[job_name].render('text')]
+
+        result_store.write(job_name, chunks, job_collector.get_constant_labels())
+
 
 def shutdown_scheduler():
     aps.shutdown()
@@ -381,6 +693,9 @@ def start_scheduler(config_name=None):
     aps.add_listener(job_completed_event_listener, EVENT_JOB_EXECUTED)
 
     if config_name is not None:
+        if result_store is not None:
+            result_store.clear()
+
         initial_run_time = datetime.now()
 
         job_list = aps.app.config.get('SCHEDULER_JOBS')
@@ -414,6 +729,27 @@ def start_scheduler(config_name=None):
 
 
 def unset_job_collector_metrics(job_name):
+    if job_name in job_collector_metrics.keys():
+        # Jobs querying rows after those already collected query every row again on their next run
+        del job_collector_metrics[job_name]
+
+    if job_name in job_expositions.keys():
+        del job_expositions[job_name]
+
+    if job_name in job_text_line_caches.keys():
+        del job_text_line_caches[job_name]
+
+    if job_name in job_row_projectors.keys():
+        del job_row_projectors[job_name]
+
+    if job_name in job_statements.keys():
+        del job_statements[job_name]
+
+    JOB_SERIES.labels(job_name).set(0)
+
+    if result_store is not None:
+        result_store.delete(job_name)
+
     if job_name in registered_collectors.keys():
         unregister_collector(job_name, registered_collectors[job_name])
 
@@ -428,6 +764,8 @@ def update_jobs(category, config_name, source_refresh_job_name):
             with aps.app.app_context():
                 config_obj.add_jobs_from_source(aa)
 
+            check_job_query_bytes(aps.app, config_obj.SCHEDULER_JOBS)
+
             job_list = aps.app.config.get('SCHEDULER_JOBS')
 
             jobs = {}
@@ -494,50 +832,114 @@ def update_jobs(category, config_name, source_refresh_job_name):
 class JobCollector:
     instance = None
 
-    def __init__(self, job_name, use_timestamp):
+    def __init__(self, job_name, use_timestamp, collector_metrics=None):
         self._job_name = job_name
         self._use_timestamp = use_timestamp
+        self._collector_metrics = collector_metrics
+        self._constant_labels = None
 
-    def collect(self):
-        for metric_name, info in job_collector_metrics[self._job_name].items():
-            json_label_data = list(info.keys())[0]
+    @property
+    def collector_metrics(self):
+        if self._collector_metrics is not None:
+            return self._collector_metrics
 
-            label_dict = json.loads(json_label_data)
+        return job_collector_metrics[self._job_name]
 
-            g = GaugeMetricFamily(metric_name.replace('.', '_'), '', labels=label_dict.keys())
+    @property
+    def use_timestamp(self):
+        return self._use_timestamp
 
-            if self.instance is None:
-                if 'instance' in label_dict.keys():
-                    self.instance = label_dict.pop('instance')
+    def generate_text_chunks(self, chunk_size):
+        """Yields the job metrics in the Prometheus text format, in chunks of roughly chunk_size bytes."""
+        lines = []
+        size = 0
+
+        for metric_name, samples in self.collector_metrics.items():
+            for line in samples.generate_text_lines(metric_name.replace('.', '_'), self._use_timestamp):
+                lines.append(line)
+                size += len(line)
+
+                if size >= chunk_size:
+                    yield ''.join(lines).encode('utf-8')
+
+                    lines = []
+                    size = 0
+
+        if lines:
+            yield ''.join(lines).encode('utf-8')
+
+    def get_constant_labels(self):
+        """Returns the labels shared by every series of the job."""
+        if self._constant_labels is None:
+            constant_labels = None
+
+            for samples in self.collector_metrics.values():
+                if constant_labels is None:
+                    constant_labels = samples.get_constant_labels()
                 else:
-                    self.instance = ''
+                    constant_labels = {
+                        label_name: value for label_name, value in samples.get_constant_labels().items() if constant_labels.get(label_name) == value
+                    }
+
+            self._constant_labels = constant_labels or {}
 
-            for json_label_data, metric in info.items():
-                label_dict = json.loads(json_label_data)
+        return self._constant_labels
 
-                options = {}
+    def collect(self):
+        for metric_name, samples in self.collector_metrics.items():
+            g = GaugeMetricFamily(metric_name.replace('.', '_'), '', labels=samples.label_names)
 
-                if self._use_timestamp:
-                    options['timestamp'] = metric[1]
+            if self.instance is None:
+                self.instance = samples.get_label_value('instance') or ''
 
-                g.add_metric(label_dict.values(), metric[0], **options)
+            if self._use_timestamp:
+                for label_values, value, timestamp in samples:
+                    g.add_metric(label_values, value, timestamp=timestamp)
+            else:
+                for label_values, value in zip(samples.label_values, samples.values):
+                    g.add_metric(label_values, value)
 
             yield g
 
 
 __all__ = [
+    'DB_CONNECT_PHASE_TIME',
+    'DB_CONNECT_TIME',
+    'DB_POOL_CHECKED_OUT',
+    'DB_POOL_CHECKOUT_TIME',
     'JOB_EXECUTION_TIME',
     'JOB_FAILURES',
+    'JOB_QUERY_EXECUTIONS_SAVED',
+    'JOB_SCRAPE_RENDER_TIME',
+    'JOB_SCRAPE_RESPONSE_SIZE',
+    'JOB_SERIES',
+    'JOB_SERIES_CHANGED',
+    'JOB_SERIES_DROPPED',
+    'JOB_SERVICE_EXECUTION_TIME',
+    'JOB_SERVICE_FAILURES',
+    'JOB_STATEMENT_CACHE',
+    'Exposition',
+    'StoredExposition',
     'TimeoutWarning',
     'aa',
     'app_registry_name',
     'aps',
     'db',
     'default_job_category',
+    'event_loop',
+    'exposition_formats',
+    'job_collector_metrics',
+    'job_row_projectors',
+    'job_statements',
     'metrics',
     'prometheus_multiproc_dir',
+    'result_store',
+    'shared_connections',
+    'shared_query_results',
+    'choose_exposition_format',
     'create_app',
     'generate_latest',
+    'get_job_exposition',
     'get_jobs',
     'get_push_services',
     'get_registry',
@@ -117,6 +117,8 @@ class Config:
         'pool_reset_on_return': None
     }
 
+    SQLALCHEMY_BINDS_ENGINE_OPTIONS = {}
+
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
     PUSH_SERVICES = {}
@@ -127,6 +129,10 @@ class Config:
 
     JOBS_SOURCE_REFRESH_INTERVAL = None
 
+    EXPOSITION_STREAMING_MIN_SERIES = int(os.getenv('EXPOSITION_STREAMING_MIN_SERIES', '100000'))
+
+    EXPOSITION_CHUNK_SIZE = int(os.getenv('EXPOSITION_CHUNK_SIZE', '65536'))
+
     SCHEDULER_JOBS = []
 
     SCHEDULER_API_ENABLED = False
@@ -202,6 +208,8 @@ class Config:
             self.SECRET_KEY
         )
 
+        self.SQLALCHEMY_BINDS_ENGINE_OPTIONS = sqlalchemy_helper.build_engine_options_dict(self._sqlalchemy_binds)
+
     @property
     def push_services(self):
         return self._push_services
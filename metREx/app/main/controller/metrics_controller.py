@@ -1,14 +1,16 @@
-from flask import request
-from flask_restx import Resource
+from timeit import default_timer
 
-from prometheus_client import CONTENT_TYPE_LATEST
+from flask import current_app, request
+from werkzeug.wsgi import wrap_file
+from flask_restx import Resource
 
 from ...main import *
+from ..util.prometheus_helper import compress_chunks, observe_chunks
 
 from ..service.metrics_service import Metrics
 
 from ..util.dto import MetricsDto
-from ..util.flask_helper import format_response
+from ..util.flask_helper import accepts_gzip, format_response
 
 api = MetricsDto.api
 
@@ -23,7 +25,66 @@ def get_parser():
     return parser
 
 
+def get_all_parser():
+    parser = api.parser()
+    parser.add_argument('category',
+                        type=str,
+                        action='append',
+                        help='Only include jobs in this category (e.g., database)',
+                        location='args')
+    parser.add_argument('label',
+                        type=str,
+                        action='append',
+                        help='Only include jobs whose series all have this label, as name:value',
+                        location='args')
+
+    return parser
+
+
 _parser = get_parser()
+_all_parser = get_all_parser()
+
+
+def format_exposition_response(exposition, formats, job_name=None):
+    exposition_format = choose_exposition_format(request.headers.get('Accept'), formats)
+
+    content_type = exposition_formats[exposition_format][0]
+
+    start_time = default_timer()
+
+    if isinstance(exposition, StoredExposition) and not accepts_gzip():
+        etag = exposition.get_etag(exposition_format)
+
+        if request.if_none_match.contains(etag):
+            # Not modified, so the file is never opened
+            result = b''
+        else:
+            # Sent straight from the result store file, using sendfile where the WSGI server supports it
+            result = current_app.response_class(wrap_file(request.environ, exposition.open()), direct_passthrough=True)
+            result.content_length = exposition.size
+
+        response = format_response(result, content_type, etag=etag)
+    elif exposition.streaming:
+        chunks = exposition.stream(exposition_format, current_app.config['EXPOSITION_CHUNK_SIZE'])
+
+        if accepts_gzip():
+            chunks = compress_chunks(chunks)
+
+        if job_name is not None:
+            # Rendered while the response is sent, so observed once the last chunk has been produced
+            chunks = observe_chunks(chunks, JOB_SCRAPE_RENDER_TIME.labels(job_name, exposition_format), JOB_SCRAPE_RESPONSE_SIZE.labels(job_name, exposition_format))
+
+        return format_response(current_app.response_class(chunks, direct_passthrough=True), content_type, 'gzip' if accepts_gzip() else None)
+    elif accepts_gzip():
+        response = format_response(exposition.compress(exposition_format), content_type, 'gzip', exposition.get_etag(exposition_format) + '-gzip')
+    else:
+        response = format_response(exposition.render(exposition_format), content_type, etag=exposition.get_etag(exposition_format))
+
+    if job_name is not None:
+        JOB_SCRAPE_RENDER_TIME.labels(job_name, exposition_format).observe(default_timer() - start_time)
+        JOB_SCRAPE_RESPONSE_SIZE.labels(job_name, exposition_format).observe(response.content_length or 0)
+
+    return response
 
 
 @api.route('')
@@ -35,9 +96,56 @@ class ApplicationMetrics(Resource):
         if prometheus_multiproc_dir is None and request.environ.get('wsgi.multiprocess', False):
             api.abort(501, "Running in multiprocess mode but 'prometheus_multiproc_dir' env var not set.")
 
-        result = Metrics.read_prometheus_metrics(app_registry_name)
+        result = Exposition(get_registry(app_registry_name))
+
+        # Protobuf exposition is limited to the gauges produced by jobs
+        return format_exposition_response(result, ('openmetrics', 'text'))
+
+
+@api.route('/all')
+@api.expect(_all_parser)
+class AllJobMetrics(Resource):
+    @api.doc('export_all_job_metrics')
+    def get(self):
+        """Export metrics for all jobs"""
+        if result_store is None and request.environ.get('wsgi.multiprocess', False):
+            api.abort(501, "Running in multiprocess mode but 'RESULT_STORE_DIR' env var not set.")
+
+        args = _all_parser.parse_args()
+
+        labels = []
+
+        for label_str in args['label'] or []:
+            label_name, sep, value = label_str.partition(':')
+
+            if not sep or not label_name:
+                api.abort(400, "Invalid label filter '" + label_str + "'. Expected 'name:value'.")
 
-        return format_response(result, CONTENT_TYPE_LATEST)
+            labels.append((label_name, value))
+
+        # OpenMetrics allows only one '# EOF' marker, so expositions can be concatenated only as text or protobuf
+        formats = ('protobuf', 'text') if result_store is None else StoredExposition.formats
+
+        for job_name in get_jobs(args['category']):
+            exposition = get_job_exposition(job_name)
+
+            if exposition is not None and exposition.streaming:
+                formats = exposition.formats
+                break
+
+        exposition_format = choose_exposition_format(request.headers.get('Accept'), formats)
+
+        content_type = exposition_formats[exposition_format][0]
+
+        compress = accepts_gzip()
+
+        # Each job's compressed exposition is sent as a separate gzip member
+        result = current_app.response_class(
+            Metrics.read_all_job_metrics(exposition_format, args['category'], labels, compress, current_app.config['EXPOSITION_CHUNK_SIZE']),
+            direct_passthrough=True
+        )
+
+        return format_response(result, content_type, 'gzip' if compress else None)
 
 
 @api.route('/<job_id>')
@@ -46,12 +154,12 @@ class JobMetrics(Resource):
     @api.doc('export_job_metrics')
     def get(self, job_id):
         """Export job metrics"""
-        if prometheus_multiproc_dir is None and request.environ.get('wsgi.multiprocess', False):
-            api.abort(501, "Running in multiprocess mode but 'prometheus_multiproc_dir' env var not set.")
+        if result_store is None and request.environ.get('wsgi.multiprocess', False):
+            api.abort(501, "Running in multiprocess mode but 'RESULT_STORE_DIR' env var not set.")
 
         if job_id in get_jobs():
-            result = Metrics.read_prometheus_metrics(job_id)
+            result = Metrics.read_job_metrics(job_id)
 
-            return format_response(result, CONTENT_TYPE_LATEST)
+            return format_exposition_response(result, result.formats, job_id)
         else:
             api.abort(404)
@@ -1,7 +1,26 @@
+import math
 import os
 import re
 
+from concurrent.futures import Future
+from threading import Lock, Thread
+from timeit import default_timer
+
 from sqlalchemy import text
+from sqlalchemy.engine.default import DefaultDialect
+
+cache_statuses = {
+    DefaultDialect.CACHE_HIT: 'hit',
+    DefaultDialect.CACHE_MISS: 'miss'
+}
+
+query_timeout_backends = [
+    'bigquery',
+    'mssql',
+    'mysql',
+    'oracle',
+    'postgresql'
+]
 
 
 class DatabaseAccessLayer:
@@ -15,12 +34,115 @@ class DatabaseAccessLayer:
 
         return os.getenv(isolation_level_env_var)
 
-    def execute(self, statement):
-        result = self._session.execute(text(statement))
+    def _set_query_timeout(self, timeout):
+        """Applies the query timeout, in seconds, in the native way of the connection's dialect."""
+        connection = self._session.connection()
+
+        backend_name = connection.engine.url.get_backend_name()
+
+        # Zero disables the timeout, so any timeout given is kept at one millisecond or more
+        milliseconds = max(int(timeout * 1000), 1) if timeout is not None else 0
+
+        if backend_name == 'postgresql':
+            if timeout is not None:
+                # Reverted when the transaction ends, so it never outlives this statement's session
+                connection.exec_driver_sql('SET LOCAL statement_timeout = %d' % milliseconds)
+        elif backend_name in ['mssql', 'mysql', 'oracle']:
+            # Session settings persist on pooled connections, so are reset once no longer wanted
+            if connection.info.get('query_timeout') == timeout:
+                return
+
+            dbapi_connection = connection.connection.connection
+
+            if backend_name == 'mysql':
+                if connection.dialect._is_mariadb:
+                    # MariaDB has no max_execution_time, but limits statements by max_statement_time, in seconds
+                    connection.exec_driver_sql('SET SESSION max_statement_time = %.3f' % (milliseconds / 1000))
+                else:
+                    connection.exec_driver_sql('SET SESSION max_execution_time = %d' % milliseconds)
+            elif backend_name == 'oracle':
+                dbapi_connection.callTimeout = milliseconds
+            elif hasattr(dbapi_connection, 'timeout'):
+                dbapi_connection.timeout = int(math.ceil(timeout)) if timeout is not None else 0
+
+            connection.info['query_timeout'] = timeout
+
+    def close(self):
+        """Closes the session, returning its connection to the pool."""
+        if self._session is not None:
+            self._session.remove()
+
+    def execute(self, statement, fetch_size=None, timeout=None, max_timeout=None, execution_options=None, parameters=None):
+        if isinstance(statement, str):
+            statement = text(statement)
+
+        # Passed with each execution, since options set on the statement itself do not override the connection's
+        options = dict(execution_options or {})
+
+        if timeout is None:
+            timeout = self._session.connection().get_execution_options().get('query_timeout')
+
+        if max_timeout is not None and (timeout is None or timeout > max_timeout):
+            timeout = max_timeout
+
+        if timeout is not None:
+            options['query_timeout'] = timeout
+
+        self._set_query_timeout(timeout)
+
+        if fetch_size is not None:
+            # Fetches rows in batches through a server-side cursor, where the dialect supports one
+            options.update({
+                'stream_results': True,
+                'max_row_buffer': fetch_size
+            })
+
+            result = self._session.execute(statement, parameters, execution_options=options)
+
+            return result.yield_per(fetch_size)
+
+        result = self._session.execute(statement, parameters, execution_options=options)
 
         return result
 
-    def init_db(self, bind):
+    @staticmethod
+    def get_cache_status(result):
+        """Returns whether the result's statement was found in the compiled statement cache ('hit' or 'miss'), or 'disabled'."""
+        return cache_statuses.get(result.context.cache_hit, 'disabled')
+
+    def get_estimated_bytes(self, bind, statement, parameters=None):
+        """Returns the number of bytes the statement would process on the bind with the parameters, estimated by the
+        dialect without running it."""
+        engine = self._db.get_engine(bind=bind)
+
+        if not hasattr(engine.dialect, 'get_estimated_bytes'):
+            raise ValueError("Estimating query bytes is not supported by dialect '" + engine.dialect.name + "'.")
+
+        if isinstance(statement, str):
+            statement = text(statement)
+
+        # Compiled as for execution, so that bind parameters are rendered in the dialect's own format
+        compiled = statement.compile(dialect=engine.dialect)
+
+        compiled_parameters = compiled.construct_params(parameters)
+
+        if compiled.positional:
+            compiled_parameters = tuple(compiled_parameters[name] for name in compiled.positiontup)
+
+        with engine.connect() as connection:
+            return engine.dialect.get_estimated_bytes(connection.connection.connection, compiled.string, compiled_parameters)
+
+    @staticmethod
+    def get_record_batches(result):
+        """Returns an iterator of the result's rows as Arrow record batches, read natively by the result's dialect."""
+        dialect = result.context.dialect
+
+        if not hasattr(dialect, 'get_record_batches'):
+            raise ValueError("Arrow record batches are not supported by dialect '" + dialect.name + "'.")
+
+        return dialect.get_record_batches(result.cursor)
+
+    def _get_engine(self, bind):
         engine = self._db.get_engine(bind=bind)
 
         options = {}
@@ -32,8 +154,124 @@ class DatabaseAccessLayer:
         if default_isolation_level is not None:
             options['isolation_level'] = default_isolation_level
 
+        return engine.execution_options(**options)
+
+    def connect(self, bind):
+        """Checks out a connection which sessions of other instances can be bound to by init_db."""
+        return self._get_engine(bind).connect()
+
+    def supports_query_timeout(self, bind):
+        """Returns whether a timeout can be given to each query run on the bind, to be enforced by the database."""
+        engine = self._db.get_engine(bind=bind)
+
+        if engine.dialect.driver == 'pymssql':
+            # pymssql only accepts a query timeout when connecting
+            return False
+
+        return engine.url.get_backend_name() in query_timeout_backends
+
+    def init_db(self, bind, connection=None):
         self._session = self._db.create_scoped_session({
             'autocommit': False,
             'autoflush': False,
-            'bind': engine.execution_options(**options)
+            'bind': connection if connection is not None else self._get_engine(bind)
         })
+
+        # Checks out the connection up front, so that connection failures surface here
+        self._session.connection()
+
+
+class SharedConnections:
+    """Work of jobs due at the same time against the same service, run in turn on one checked-out connection.
+
+    The work is run by a runner thread, started when the first job arrives, which checks out the connection and keeps
+    it until no work is left. Each job waits only for the outcome of its own work, so its failures are its own.
+    """
+    def __init__(self):
+        self._pending = {}
+        self._lock = Lock()
+
+    def _run_pending(self, key, connect):
+        connection = None
+
+        try:
+            while True:
+                with self._lock:
+                    if not self._pending[key]:
+                        del self._pending[key]
+                        break
+
+                    work, future = self._pending[key].pop(0)
+
+                try:
+                    if connection is None or connection.invalidated:
+                        # Reconnects for the remaining work if the connection was lost by earlier work
+                        if connection is not None:
+                            connection.close()
+
+                            connection = None
+
+                        connection = connect()
+
+                    future.set_result(work(connection))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def run(self, key, work, connect):
+        """Returns the result of work(connection), run on the connection shared under key, checked out by connect()."""
+        future = Future()
+
+        with self._lock:
+            if key not in self._pending.keys():
+                self._pending[key] = []
+
+                Thread(target=self._run_pending, args=(key, connect), name='SharedConnection-' + str(key), daemon=True).start()
+
+            self._pending[key].append((work, future))
+
+        return future.result()
+
+
+class SharedResults:
+    """Results of queries shared by a group of jobs, fetched by whichever job runs first and reused by the others.
+
+    A result is reused at most once by each job in the group, and only while it is younger than max_age seconds,
+    so each job still sees rows fetched since its previous run. It is dropped once every job has used it.
+    """
+    def __init__(self):
+        self._results = {}
+        self._locks = {}
+        self._lock = Lock()
+
+    def get(self, key, job_name, group_size, max_age, fetch):
+        """Returns the result shared under key, calling fetch() for a new one if needed, and whether it was reused."""
+        with self._lock:
+            if key not in self._locks.keys():
+                self._locks[key] = Lock()
+
+            lock = self._locks[key]
+
+        # Jobs of the same group which run at the same time wait for the first to fetch the result
+        with lock:
+            if key in self._results.keys():
+                fetch_time, result, job_names = self._results[key]
+
+                if job_name not in job_names and default_timer() - fetch_time < max_age:
+                    job_names.add(job_name)
+
+                    if len(job_names) >= group_size:
+                        del self._results[key]
+
+                    return result, True
+
+            fetch_time = default_timer()
+
+            result = fetch()
+
+            if group_size > 1:
+                self._results[key] = (fetch_time, result, {job_name})
+
+            return result, False
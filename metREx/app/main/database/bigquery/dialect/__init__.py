@@ -1,10 +1,40 @@
 import json
 
+from google.cloud.bigquery import QueryJobConfig
+
 from pybigquery.sqlalchemy_bigquery import BigQueryDialect as BaseDialect
 
+query_job_options = [
+    'maximum_bytes_billed',
+    'use_query_cache'
+]
+
 
 class BigQueryDialect(BaseDialect):
-    supports_statement_cache = False
+    supports_statement_cache = True
+
+    _bqstorage_client = None
+
+    def _get_bqstorage_client(self, client):
+        try:
+            from google.cloud import bigquery_storage
+        except ImportError:
+            return None
+
+        # Kept for the life of the engine, rather than created and closed with each DB-API connection
+        if self._bqstorage_client is None:
+            self._bqstorage_client = bigquery_storage.BigQueryReadClient(credentials=client._credentials)
+
+        return self._bqstorage_client
+
+    def connect(self, *cargs, **cparams):
+        if cargs and 'bqstorage_client' not in cparams.keys():
+            bqstorage_client = self._get_bqstorage_client(cargs[0])
+
+            if bqstorage_client is not None:
+                cparams['bqstorage_client'] = bqstorage_client
+
+        return super(BigQueryDialect, self).connect(*cargs, **cparams)
 
     def create_connect_args(self, url):
         query = url.query
@@ -13,3 +43,44 @@ class BigQueryDialect(BaseDialect):
             self.credentials_info = json.loads(query['credentials_info'])
 
         return super(BigQueryDialect, self).create_connect_args(url)
+
+    def do_execute(self, cursor, statement, parameters, context=None):
+        execution_options = context.execution_options if context is not None else {}
+
+        options = {
+            option: execution_options[option] for option in query_job_options if execution_options.get(option) is not None
+        }
+
+        timeout = execution_options.get('query_timeout')
+
+        if timeout is not None:
+            # BigQuery cancels the query job itself once the timeout is reached
+            options['job_timeout_ms'] = int(timeout * 1000)
+
+        if options:
+            cursor.execute(statement, parameters, job_config=QueryJobConfig(**options))
+        else:
+            super(BigQueryDialect, self).do_execute(cursor, statement, parameters, context)
+
+    def get_estimated_bytes(self, dbapi_connection, statement, parameters=None):
+        """Returns the number of bytes the compiled statement would process with the parameters, estimated by a dry run
+        of its query job."""
+        cursor = dbapi_connection.cursor()
+
+        try:
+            # Run by the DB-API cursor, so that the parameters are bound as they are when the statement is executed
+            cursor.execute(statement, parameters, job_config=QueryJobConfig(dry_run=True, use_query_cache=False))
+
+            return cursor._query_job.total_bytes_processed
+        finally:
+            cursor.close()
+
+    def get_record_batches(self, cursor):
+        """Returns an iterator of the DB-API cursor's query results as Arrow record batches.
+
+        Results are read through the BigQuery Storage Read API, where the connection has a client for it.
+        """
+        # Read from the query job run by the cursor, so that no rows are converted by the DB-API
+        rows = cursor._query_job.result()
+
+        return rows.to_arrow_iterable(bqstorage_client=getattr(cursor.connection, '_bqstorage_client', None))
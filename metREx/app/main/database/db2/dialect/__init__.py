@@ -2,7 +2,7 @@ from ibm_db_sa.ibm_db import dialect
 
 
 class DB2Dialect(dialect):
-    supports_statement_cache = False
+    supports_statement_cache = True
 
     def get_isolation_level(self, connection):
         return 'CS'
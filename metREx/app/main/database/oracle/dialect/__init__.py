@@ -0,0 +1,62 @@
+from threading import Lock
+
+from sqlalchemy.dialects.oracle.cx_oracle import OracleDialect_cx_oracle as BaseDialect
+
+cursor_options = [
+    'arraysize',
+    'prefetchrows'
+]
+
+
+class OracleDialect(BaseDialect):
+    supports_statement_cache = True
+
+    def __init__(self, session_pool=None, drcp_connection_class=None, **kwargs):
+        super(OracleDialect, self).__init__(**kwargs)
+
+        self.session_pool = session_pool
+        self.drcp_connection_class = drcp_connection_class
+
+        self._session_pool = None
+        self._session_pool_lock = Lock()
+
+    def _get_session_pool(self, cparams):
+        with self._session_pool_lock:
+            if self._session_pool is None:
+                options = {
+                    'threaded': True
+                }
+
+                options.update(cparams)
+
+                for option in ['min', 'max', 'increment']:
+                    options[option] = self.session_pool[option]
+
+                self._session_pool = self.dbapi.SessionPool(**options)
+
+            return self._session_pool
+
+    def connect(self, *cargs, **cparams):
+        drcp_args = {}
+
+        if self.drcp_connection_class is not None:
+            # Sessions are shared through Database Resident Connection Pooling (DRCP) with others of the same class
+            drcp_args = {
+                'cclass': self.drcp_connection_class,
+                'purity': self.dbapi.ATTR_PURITY_SELF
+            }
+
+        if self.session_pool is None:
+            return super(OracleDialect, self).connect(*cargs, **cparams, **drcp_args)
+
+        # Acquired from the session pool, to which it is released when closed, rather than opening a new session
+        return self._get_session_pool(cparams).acquire(**drcp_args)
+
+    def do_execute(self, cursor, statement, parameters, context=None):
+        if context is not None:
+            # Set before the statement is executed, so that rows are prefetched with its execution
+            for option in cursor_options:
+                if context.execution_options.get(option) is not None:
+                    setattr(cursor, option, context.execution_options[option])
+
+        super(OracleDialect, self).do_execute(cursor, statement, parameters, context)
@@ -6,6 +6,8 @@ from sqlalchemy.dialects.postgresql.pg8000 import PGDialect_pg8000 as BaseDialec
 
 
 class PostgreSQLDialect(BaseDialect):
+    supports_statement_cache = True
+
     def _get_server_version_info(self, connection):
         v = connection.exec_driver_sql("select pg_catalog.version()").scalar()
 
@@ -1,15 +1,23 @@
-import json
+import asyncio
 import re
 import traceback
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
-from datetime import datetime, timezone
+from datetime import date, datetime, time, timezone
+from timeit import default_timer
 
 import inflect
 import numpy
 import pytz
 
+from apscheduler.schedulers.base import MaxInstancesReachedError
+
+from sqlalchemy import text
+from sqlalchemy.util import greenlet_spawn
+
 from ..api.appd import AppD
 from ..api.extrahop import ExtraHop
 from ..api.newrelic import NewRelic
@@ -17,6 +25,12 @@ from ..database import DatabaseAccessLayer
 
 from ...main import *
 from ..util.multiprocessing_helper import *
+from ..util.prometheus_helper import compress_chunks, observe_chunks
+from ..util.sample_helper import intern_label_value, CollectorMetrics
+from ..util.sqlalchemy_helper import last_timestamp_default, last_timestamp_param_pattern
+
+# The number of rows converted to metrics at a time, column by column
+transform_batch_size = 10000
 
 
 def aggregate_values_by_func(func, values):
@@ -40,6 +54,23 @@ def aggregate_values_by_func(func, values):
     return value
 
 
+def execute_job_statement(dal, job_name, statement, fetch_size=None, query_timeout=None, query_deadline=None, execution_options=None, parameters=None):
+    max_query_timeout = None
+
+    if query_deadline is not None:
+        # Each query is limited to the time left before the deadline, so the job's queries together still end by then
+        max_query_timeout = query_deadline - default_timer()
+
+        if max_query_timeout <= 0:
+            raise TimeoutWarning("Queries timed out.")
+
+    result = dal.execute(get_job_statement(job_name, statement), fetch_size, query_timeout, max_query_timeout, execution_options, parameters)
+
+    JOB_STATEMENT_CACHE.labels(job_name, dal.get_cache_status(result)).inc()
+
+    return result
+
+
 def format_label(string):
     label = re.sub(r'[().\'\"]|((?<![/:])/)', '', string)
     label = re.sub(r'^%(?=\w)', 'percent ', label)
@@ -63,18 +94,13 @@ def format_metric(string):
     return metric.lower()
 
 
-def get_metrics(func, job_name, args, push_services, conn=None):
-    collector_metrics = func(*args)
+def get_metrics(func, job_name, args, push_services, conn=None, kwargs=None):
+    collector_metrics = func(*args, **(kwargs or {}))
 
     if conn is not None:
         conn.send(collector_metrics)
 
-    aps.app.logger.info("Fetched metrics for job '" + job_name + "'.")
-
-    set_job_collector_metrics(job_name, collector_metrics, push_services)
-
-    for vendor, services in push_services.items():
-        globals()['push_' + vendor + '_job_metrics'](job_name, services)
+    publish_metrics(job_name, collector_metrics, push_services)
 
 
 def get_metric_info(service):
@@ -94,6 +120,27 @@ def get_metric_info(service):
     return prefix.lower(), instance
 
 
+def get_job_statement(job_name, statement):
+    """Returns the job's statement as a text construct, reused across runs while the statement is unchanged."""
+    if job_name not in job_statements.keys() or job_statements[job_name][0] != statement:
+        job_statements[job_name] = (statement, text(statement))
+
+    return job_statements[job_name][1]
+
+
+def get_row_projector(job_name, columns, prefix, value_columns, static_labels=(), timestamp_column=None, instance=None):
+    """Returns the job's row projector for the result columns, compiling it the first time they are seen."""
+    key = (tuple(columns), prefix, tuple(value_columns), tuple(map(tuple, static_labels)), timestamp_column, instance)
+
+    if job_name not in job_row_projectors.keys():
+        job_row_projectors[job_name] = {}
+
+    if key not in job_row_projectors[job_name].keys():
+        job_row_projectors[job_name][key] = RowProjector(job_name, *key)
+
+    return job_row_projectors[job_name][key]
+
+
 def is_element_in_iterable_no_case(element, iterable):
     return element.lower() in [val.lower() for val in list(iterable)]
 
@@ -107,6 +154,44 @@ def is_number(n):
     return True
 
 
+def iterate_record_batch_columns(batches):
+    """Yields Arrow record batches as (row count, None, columns), leaving their columns to be converted natively."""
+    for batch in batches:
+        yield batch.num_rows, None, batch.columns
+
+
+def iterate_row_batches(rows):
+    """Yields the rows in batches of up to transform_batch_size, as (row count, rows, None)."""
+    rows = iter(rows)
+
+    while True:
+        batch = list(islice(rows, transform_batch_size))
+
+        if not batch:
+            break
+
+        yield len(batch), batch, None
+
+
+def iterate_service_samples(collector_metrics, service_name):
+    """Yields the samples collected from the service, as (metric name, label names, label values, value, timestamp)."""
+    prefix, instance = get_metric_info(service_name)
+
+    for metric_name, samples in collector_metrics.items():
+        if not metric_name.startswith(prefix + '.'):
+            continue
+
+        # Services sharing a prefix are told apart by their instance label, where one is applied
+        instance_index = None
+
+        if instance is not None and 'instance' in samples.label_names:
+            instance_index = samples.label_names.index('instance')
+
+        for label_values, value, timestamp in samples:
+            if instance_index is None or label_values[instance_index] == instance:
+                yield metric_name, samples.label_names, label_values, value, timestamp
+
+
 def make_label_singular(label):
     p = inflect.engine()
 
@@ -117,6 +202,61 @@ def make_label_singular(label):
     return '_'.join(words)
 
 
+def publish_metrics(job_name, collector_metrics, push_services):
+    aps.app.logger.info("Fetched metrics for job '" + job_name + "'.")
+
+    set_job_collector_metrics(job_name, collector_metrics, push_services)
+
+    for vendor, services in push_services.items():
+        globals()['push_' + vendor + '_job_metrics'](job_name, services)
+
+
+def run_database_work(job_name, service_name, work):
+    """Returns the result of work(dal), given a database access layer with a session on the service.
+
+    If the service shares its connection, the work is run on the connection checked out for any other jobs due at the
+    same time, each in a session of its own. Connections of async drivers are never shared, since the coroutines of
+    their jobs already run on a single thread.
+    """
+    dal = DatabaseAccessLayer(db)
+
+    engine = db.get_engine(bind=service_name)
+
+    if engine.get_execution_options().get('share_connection') and not engine.dialect.is_async:
+        def _connect():
+            with aps.app.app_context():
+                with DB_POOL_CHECKOUT_TIME.labels(service_name).time():
+                    connection = dal.connect(service_name)
+
+                aps.app.logger.info("Initialized shared connection to database service '" + service_name + "'.")
+
+            return connection
+
+        def _run_work(connection):
+            with aps.app.app_context():
+                # Timed here, rather than by the waiting job, so the work of jobs ahead of it is not included
+                with JOB_SERVICE_EXECUTION_TIME.labels(job_name, service_name).time():
+                    dal.init_db(service_name, connection)
+
+                    try:
+                        return work(dal)
+                    finally:
+                        dal.close()
+
+        return shared_connections.run(service_name, _run_work, _connect)
+
+    with JOB_SERVICE_EXECUTION_TIME.labels(job_name, service_name).time():
+        with DB_POOL_CHECKOUT_TIME.labels(service_name).time():
+            dal.init_db(service_name)
+
+        aps.app.logger.info("Initialized connection for job '" + job_name + "' to database service '" + service_name + "'.")
+
+        try:
+            return work(dal)
+        finally:
+            dal.close()
+
+
 def test_aggregation_match(value, aggregation):
     if 'threshold' in aggregation.keys():
         return eval('%d %s %d' % (value, aggregation['threshold']['operator'], int(aggregation['threshold']['value'])))
@@ -174,14 +314,93 @@ def test_aggregation_settings(aggregation, job_name):
     return aggregation
 
 
+def to_datetime(value):
+    """Returns a date or ISO 8601 string value as a datetime, rejecting any other value."""
+    if isinstance(value, date):
+        return datetime.combine(value, time())
+
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            pass
+
+    raise ValueError("Invalid timestamp value '" + to_string(value) + "'.")
+
+
+def to_label_column(values):
+    """Returns the values of a column as interned label values, converting each distinct value only once."""
+    if hasattr(values, 'dictionary_encode'):
+        # Arrow arrays are dictionary encoded natively, with nulls given the index after the last distinct value
+        encoded = values.dictionary_encode()
+
+        labels = [intern_label_value(to_string(value)) for value in encoded.dictionary.to_pylist()] + [intern_label_value('')]
+
+        indices = encoded.indices.fill_null(len(labels) - 1).to_numpy(zero_copy_only=False)
+
+        return list(map(labels.__getitem__, indices.tolist()))
+
+    if hasattr(values, 'to_pylist'):
+        values = values.to_pylist()
+
+    # Only strings are mapped, since other values may be equal while their labels differ (e.g., Decimal 1.0 and 1.00)
+    if set(map(type, values)) <= {str, type(None)}:
+        labels = {
+            value: intern_label_value(to_string(value)) for value in set(values)
+        }
+
+        return list(map(labels.__getitem__, values))
+
+    return [intern_label_value(to_string(value)) for value in values]
+
+
 def to_string(n):
     return str(n) if n is not None else ''
 
 
+def to_timestamp(value, tzinfo, default=None):
+    """Returns the epoch timestamp of a datetime value, localizing it to tzinfo if it is naive.
+
+    Other values are given the default timestamp or, without one, converted by to_datetime.
+    """
+    if not isinstance(value, datetime):
+        if default is not None:
+            return default
+
+        value = to_datetime(value)
+
+    if value.tzinfo is not None and value.tzinfo.utcoffset(value) is not None:
+        return value.timestamp()
+
+    return tzinfo.localize(value).timestamp()
+
+
+def to_timestamp_column(values, tzinfo, default=None):
+    """Returns the epoch timestamps of a column of datetime values as a NumPy array, converting each distinct value
+    only once."""
+    if hasattr(values, 'to_pylist'):
+        values = values.to_pylist()
+
+    timestamps = {
+        value: to_timestamp(value, tzinfo, default) for value in set(values)
+    }
+
+    return numpy.fromiter(map(timestamps.__getitem__, values), dtype=numpy.float64, count=len(values))
+
+
+def to_value_column(values):
+    """Returns the values of a column as a NumPy array of floats, with None values as NaN."""
+    if hasattr(values, 'to_numpy'):
+        # Arrow arrays are converted natively, without creating a Python object for each value
+        values = values.to_numpy(zero_copy_only=False)
+
+    return numpy.asarray(values, dtype=numpy.float64)
+
+
 class Metrics:
     @staticmethod
-    def _get_appdynamics_metrics(job_name, service_names, application, metric_path, minutes, static_labels=()):
-        collector_metrics = {}
+    def _get_appdynamics_metrics(job_name, service_names, application, metric_path, minutes, static_labels=(), max_series=None, max_label_values=None):
+        collector_metrics = CollectorMetrics(max_series, max_label_values)
 
         with aps.app.app_context():
             all_labels = []
@@ -392,108 +611,144 @@ class Metrics:
 
             for metric_name, data in metric_data.items():
                 for (label_dict, value, timestamp) in data:
-                    normalized_label_dict = OrderedDict()
+                    label_values = tuple(
+                        label_dict[label] if label in label_dict.keys() else '' for label in all_labels
+                    )
 
-                    for label in all_labels:
-                        if label in label_dict.keys():
-                            normalized_label_dict[label] = label_dict[label]
-                        else:
-                            normalized_label_dict[label] = ''
+                    collector_metrics.add_sample(metric_name, all_labels, label_values, value, timestamp)
 
-                    json_label_data = json.dumps(normalized_label_dict)
+        return collector_metrics
+
+    @staticmethod
+    def _collect_database_service_metrics(job_name, service_name, service_names, collector_metrics, *args):
+        """Adds the metrics of one of the job's services to collector_metrics and returns it, counting any failure
+        against the service. Shared by the sync and async versions of _get_database_metrics."""
+        if collector_metrics.is_full:
+            # Services queried once the job's limit is reached could add no series
+            return collector_metrics
 
-                    if metric_name not in collector_metrics.keys():
-                        collector_metrics[metric_name] = {}
+        with aps.app.app_context():
+            try:
+                Metrics._get_database_service_metrics(job_name, service_name, service_names, collector_metrics, *args)
+            except Exception as e:
+                JOB_SERVICE_FAILURES.labels(job_name, service_name, e.__class__.__name__).inc()
 
-                    if json_label_data not in collector_metrics[metric_name].keys():
-                        collector_metrics[metric_name][json_label_data] = (value, timestamp)
+                raise e
 
         return collector_metrics
 
     @staticmethod
-    def _get_database_metrics(job_name, service_names, statement, value_columns, static_labels=(), timestamp_column=None, timezones={}):
-        def is_value_column(column):
-            return is_element_in_iterable_no_case(column, value_columns)
+    def _get_database_metrics(job_name, service_names, statement, value_columns, static_labels=(), timestamp_column=None, timezones={}, max_series=None, max_label_values=None, fetch_size=None, parallelism=None, query_timeout=None, query_group=None, query_deadline=None, use_bqstorage_api=False, execution_options=None):
+        service_args = (statement, value_columns, static_labels, timestamp_column, timezones, fetch_size, query_timeout, query_group, query_deadline, use_bqstorage_api, execution_options)
 
-        collector_metrics = {}
+        collector_metrics = CollectorMetrics(max_series, max_label_values)
 
-        with aps.app.app_context():
+        if parallelism is not None and parallelism > 1 and len(service_names['source']) > 1:
+            with ThreadPoolExecutor(max_workers=min(parallelism, len(service_names['source']))) as executor:
+                futures = [
+                    executor.submit(Metrics._collect_database_service_metrics, job_name, service_name, service_names, CollectorMetrics(max_series, max_label_values), *service_args) for service_name in service_names['source']
+                ]
+
+            Metrics._merge_database_service_metrics(collector_metrics, [future.result() for future in futures])
+        else:
             for service_name in service_names['source']:
-                prefix, instance = get_metric_info(service_name)
+                Metrics._collect_database_service_metrics(job_name, service_name, service_names, collector_metrics, *service_args)
 
-                dal = DatabaseAccessLayer(db)
-                dal.init_db(service_name)
+        return collector_metrics
 
-                aps.app.logger.info("Initialized connection for job '" + job_name + "' to database service '" + service_name + "'.")
+    @staticmethod
+    async def _get_database_metrics_async(job_name, service_names, statement, value_columns, static_labels=(), timestamp_column=None, timezones={}, max_series=None, max_label_values=None, fetch_size=None, parallelism=None, query_timeout=None, query_group=None, query_deadline=None, use_bqstorage_api=False, execution_options=None):
+        """Gets the same metrics as _get_database_metrics, for services with async drivers.
 
-                result = dal.execute(statement)
+        The queries of each service are run in a greenlet, in which the driver awaits its IO on the event loop.
+        """
+        service_args = (statement, value_columns, static_labels, timestamp_column, timezones, fetch_size, query_timeout, query_group, query_deadline, use_bqstorage_api, execution_options)
 
-                timestamp = datetime.now(timezone.utc).timestamp()
+        semaphore = asyncio.Semaphore(parallelism or 1)
 
-                db_tzinfo = None
+        async def _get_service_metrics_async(service_name):
+            async with semaphore:
+                return await greenlet_spawn(Metrics._collect_database_service_metrics, job_name, service_name, service_names, CollectorMetrics(max_series, max_label_values), *service_args)
 
-                if timestamp_column is not None and service_name in timezones.keys():
-                    db_tzinfo = pytz.timezone(timezones[service_name])
+        collector_metrics = CollectorMetrics(max_series, max_label_values)
 
-                normalized_value_columns = None
-                normalized_timestamp_column = None
+        results = await asyncio.gather(*[
+            _get_service_metrics_async(service_name) for service_name in service_names['source']
+        ])
 
-                for row in result:
-                    def is_unmatched_value_column(column):
-                        return not is_element_in_iterable_no_case(column, row.keys())
+        Metrics._merge_database_service_metrics(collector_metrics, results)
 
-                    if normalized_value_columns is None:
-                        normalized_value_columns = list(filter(is_value_column, row.keys()))
+        return collector_metrics
 
-                        unmatched_value_columns = list(filter(is_unmatched_value_column, value_columns))
+    @staticmethod
+    def _get_database_service_metrics(job_name, service_name, service_names, collector_metrics, statement, value_columns, static_labels=(), timestamp_column=None, timezones={}, fetch_size=None, query_timeout=None, query_group=None, query_deadline=None, use_bqstorage_api=False, execution_options=None):
+        if query_group is not None:
+            def _fetch_rows(dal):
+                result = execute_job_statement(dal, job_name, statement, query_timeout=query_timeout, query_deadline=query_deadline, execution_options=execution_options)
 
-                        if unmatched_value_columns:
-                            raise ValueError("Value column(s) " + ", ".join(["'" + column + "'" for column in unmatched_value_columns]) + " specified in job '" + job_name + "' not returned in query result.")
+                # Record batches are kept as they are, leaving their columns to be converted by each job
+                data = list(dal.get_record_batches(result)) if use_bqstorage_api else result.all()
 
-                    if timestamp_column is not None and normalized_timestamp_column is None:
-                        for column in row.keys():
-                            if timestamp_column.lower() == column.lower():
-                                normalized_timestamp_column = column
+                return tuple(result.keys()), data, datetime.now(timezone.utc).timestamp()
 
-                        if normalized_timestamp_column is None:
-                            raise ValueError("Timestamp column '" + timestamp_column + "' specified in job '" + job_name + "' not returned in query result.")
+            # Identical queries scheduled by other jobs of the group are executed once per run, and their rows shared
+            (columns, data, timestamp), reused = shared_query_results.get(
+                (query_group['name'], service_name),
+                job_name,
+                query_group['size'],
+                query_group['interval'],
+                lambda: run_database_work(job_name, service_name, _fetch_rows)
+            )
 
-                    label_dict = OrderedDict()
+            if reused:
+                JOB_QUERY_EXECUTIONS_SAVED.labels(job_name).inc()
 
-                    if service_names['push'] or aps.app.config['DEFAULT_PUSH_SERVICE_NAMES']:
-                        if instance is not None:
-                            label_dict['instance'] = instance
+            batches = iterate_record_batch_columns(data) if use_bqstorage_api else iterate_row_batches(data)
 
-                    label_dict.update(OrderedDict([
-                        (format_label(column), to_string(row[column])) for column in row.keys() if column not in normalized_value_columns and column != normalized_timestamp_column
-                    ]))
+            Metrics._transform_database_rows(job_name, service_name, service_names, collector_metrics, columns, batches, timestamp, value_columns, static_labels, timestamp_column, timezones)
+        else:
+            parameters = None
+            previous_samples = []
 
-                    label_dict.update(OrderedDict([
-                        (format_label(label), value) for label, value in static_labels if format_label(label) not in label_dict.keys()
-                    ]))
+            is_incremental = timestamp_column is not None and last_timestamp_param_pattern.search(statement) is not None
 
-                    if db_tzinfo is not None:
-                        if isinstance(row[normalized_timestamp_column], datetime):
-                            if row[normalized_timestamp_column].tzinfo is not None and row[normalized_timestamp_column].tzinfo.utcoffset(row[normalized_timestamp_column]) is not None:
-                                timestamp = row[normalized_timestamp_column].timestamp()
-                            else:
-                                timestamp = row[normalized_timestamp_column].astimezone(db_tzinfo).timestamp()
+            if is_incremental:
+                # Only rows after the latest already collected from the service are queried
+                previous_samples = list(iterate_service_samples(job_collector_metrics.get(job_name, {}), service_name))
 
-                    json_label_data = json.dumps(label_dict)
+                last_timestamp = last_timestamp_default
 
-                    for column in normalized_value_columns:
-                        metric_name = '%s.%s' % (prefix, format_metric(column))
+                if previous_samples:
+                    # Sample timestamps of these jobs are only ever taken from the timestamp column
+                    db_tzinfo = pytz.timezone(timezones[service_name])
 
-                        if metric_name not in collector_metrics.keys():
-                            collector_metrics[metric_name] = {}
+                    last_timestamp = datetime.fromtimestamp(max([sample[4] for sample in previous_samples]), db_tzinfo).replace(tzinfo=None)
 
-                        if json_label_data not in collector_metrics[metric_name].keys():
-                            collector_metrics[metric_name][json_label_data] = (row[column], timestamp)
+                parameters = {
+                    'last_timestamp': last_timestamp
+                }
 
-        return collector_metrics
+            def _get_metrics(dal):
+                result = execute_job_statement(dal, job_name, statement, fetch_size, query_timeout, query_deadline, execution_options, parameters)
+
+                timestamp = datetime.now(timezone.utc).timestamp()
+
+                batches = iterate_record_batch_columns(dal.get_record_batches(result)) if use_bqstorage_api else iterate_row_batches(result)
+
+                # Rows without a valid timestamp are rejected, so that none is given the time of the query instead
+                Metrics._transform_database_rows(job_name, service_name, service_names, collector_metrics, result.keys(), batches, timestamp, value_columns, static_labels, timestamp_column, timezones, is_incremental)
+
+                # Releases any server-side cursor left open by skipped rows
+                result.close()
+
+            run_database_work(job_name, service_name, _get_metrics)
+
+            # Series collected before are kept, unless the new rows returned them again
+            for sample in previous_samples:
+                collector_metrics.keep_sample(*sample)
 
     @staticmethod
-    def _get_extrahop_metrics(job_name, service_names, params, metric, aggregation, minutes, static_labels=()):
+    def _get_extrahop_metrics(job_name, service_names, params, metric, aggregation, minutes, static_labels=(), max_series=None, max_label_values=None):
         def _get_metrics():
             _metrics = []
 
@@ -518,7 +773,7 @@ class Metrics:
 
             return _metrics
 
-        collector_metrics = {}
+        collector_metrics = CollectorMetrics(max_series, max_label_values)
 
         aggregation = test_aggregation_settings(aggregation, job_name)
 
@@ -567,25 +822,21 @@ class Metrics:
                             (format_label(label), value) for label, value in static_labels if format_label(label) not in label_dict.keys()
                         ]))
 
-                        json_label_data = json.dumps(label_dict)
+                        label_values = tuple(label_dict.values())
 
                         for func in aggregation['funcs']:
                             metric_name = '%s.%s.%s' % (prefix, format_metric(metric), func.lower())
 
-                            if metric_name not in collector_metrics.keys():
-                                collector_metrics[metric_name] = {}
-
-                            if json_label_data not in collector_metrics[metric_name].keys():
-                                collector_metrics[metric_name][json_label_data] = (aggregate_values_by_func(func, values), timestamp)
+                            collector_metrics.add_sample(metric_name, label_dict.keys(), label_values, aggregate_values_by_func(func, values), timestamp)
 
         return collector_metrics
 
     @staticmethod
-    def _get_newrelic_metrics(job_name, service_names, account_id, statement, value_attrs, minutes, static_labels=()):
+    def _get_newrelic_metrics(job_name, service_names, account_id, statement, value_attrs, minutes, static_labels=(), max_series=None, max_label_values=None):
         def is_value_attr(attr):
             return is_element_in_iterable_no_case(attr, value_attrs)
 
-        collector_metrics = {}
+        collector_metrics = CollectorMetrics(max_series, max_label_values)
 
         with aps.app.app_context():
             nrql_query = re.sub(r'[\r\n]+', ' ', statement)
@@ -618,6 +869,8 @@ class Metrics:
                     if result['data']['actor']['account']['nrql']['results']:
                         normalized_value_attrs = None
 
+                        is_full = collector_metrics.is_full
+
                         for row in result['data']['actor']['account']['nrql']['results']:
                             def is_unmatched_value_attr(attr):
                                 return not is_element_in_iterable_no_case(attr, row.keys())
@@ -630,6 +883,10 @@ class Metrics:
                                 if unmatched_value_attrs:
                                     raise ValueError("Value attribute(s) " + ", ".join(["'" + attr + "'" for attr in unmatched_value_attrs]) + " specified in job '" + job_name + "' not returned in query result.")
 
+                            if is_full:
+                                collector_metrics.dropped_series_count += len(normalized_value_attrs)
+                                continue
+
                             label_dict = OrderedDict()
 
                             if service_names['push'] or aps.app.config['DEFAULT_PUSH_SERVICE_NAMES']:
@@ -644,21 +901,177 @@ class Metrics:
                                 (format_label(label), value) for label, value in static_labels if format_label(label) not in label_dict.keys()
                             ]))
 
-                            json_label_data = json.dumps(label_dict)
+                            label_values = tuple(label_dict.values())
 
                             for attr in normalized_value_attrs:
                                 metric_name = '%s.%s' % (prefix, format_metric(attr))
 
-                                if metric_name not in collector_metrics.keys():
-                                    collector_metrics[metric_name] = {}
+                                collector_metrics.add_sample(metric_name, label_dict.keys(), label_values, row[attr], timestamp)
+
+                            if collector_metrics.is_full:
+                                aps.app.logger.warning("Job '" + job_name + "' reached its limit of " + str(max_series) + " series. The series of any remaining rows were dropped.")
 
-                                if json_label_data not in collector_metrics[metric_name].keys():
-                                    collector_metrics[metric_name][json_label_data] = (row[attr], timestamp)
+                                is_full = True
 
         return collector_metrics
 
     @staticmethod
-    def generate_metrics(*args):
+    def _handle_job_failure(job_name, category, e):
+        exception = e.__class__.__name__
+
+        JOB_FAILURES.labels(job_name, category, exception).inc()
+
+        aps.app.logger.warning("Job '" + job_name + "' failed. " + exception + ": " + str(e))
+        aps.app.logger.debug(traceback.format_exc())
+
+        if aps.app.config['SUSPEND_JOB_ON_FAILURE']:
+            aps.pause_job(job_name)
+
+            aps.app.logger.warning("Job '" + job_name + "' suspended.")
+
+        unset_job_collector_metrics(job_name)
+
+    @staticmethod
+    def _merge_database_service_metrics(collector_metrics, service_collector_metrics_list):
+        # Merged in the order the services are listed, so the result does not depend on which finished first
+        for service_collector_metrics in service_collector_metrics_list:
+            collector_metrics.merge(service_collector_metrics)
+
+    @staticmethod
+    def _run_database_job_async(job, args, kwargs):
+        """Submits the database job to the event loop and returns the future of its run, without waiting on it.
+
+        Runs beyond the job's max instances are skipped, as the scheduler itself would.
+        """
+        category = args[0]
+        job_name = args[1]
+        service_names = args[2]
+
+        if event_loop.get_running_count(job_name) >= job.max_instances:
+            JOB_EXECUTION_TIME.labels(job_name, category).observe(0.0)
+            JOB_FAILURES.labels(job_name, category, MaxInstancesReachedError.__name__).inc()
+
+            aps.app.logger.warning("Job '" + job_name + "' skipped. Maximum number of running instances reached (" + str(job.max_instances) + ").")
+
+            return None
+
+        push_services = get_push_services(
+            job_name,
+            (aps.app.config['DEFAULT_PUSH_SERVICE_NAMES'] + service_names['push'])
+        )
+
+        max_execution_time = None
+
+        if aps.app.config['LIMIT_JOB_EXECUTION_TIME'] and job.next_run_time is not None:
+            end_dt = job.next_run_time
+            job_tz = pytz.timezone(end_dt.tzname())
+
+            max_execution_time = max((end_dt - datetime.now(job_tz)).total_seconds() - 1, 1)
+
+        start_time = default_timer()
+
+        def _finish(collector_metrics, exception):
+            with aps.app.app_context():
+                try:
+                    if exception is not None:
+                        raise exception
+
+                    publish_metrics(job_name, collector_metrics, push_services)
+                except Exception as e:
+                    Metrics._handle_job_failure(job_name, category, e)
+                finally:
+                    JOB_EXECUTION_TIME.labels(job_name, category).observe(default_timer() - start_time)
+
+        async def _run():
+            collector_metrics = None
+            exception = None
+
+            try:
+                # Queries still running at the next scheduled runtime are cancelled
+                collector_metrics = await asyncio.wait_for(Metrics._get_database_metrics_async(*args[1:], **kwargs), max_execution_time)
+            except asyncio.TimeoutError:
+                exception = TimeoutWarning("Queries timed out.")
+            except Exception as e:
+                exception = e
+
+            # Metrics are rendered and pushed in the loop's executor, so the queries of other jobs are not held up
+            await asyncio.get_running_loop().run_in_executor(None, _finish, collector_metrics, exception)
+
+        return event_loop.submit(_run(), job_name)
+
+    @staticmethod
+    def _transform_database_rows(job_name, service_name, service_names, collector_metrics, columns, batches, timestamp, value_columns, static_labels=(), timestamp_column=None, timezones={}, strict_timestamps=False):
+        """Adds the metrics of the result rows, given as batches of (row count, rows, columns) holding either the rows or
+        their columns.
+
+        Rows whose timestamp column is not a datetime are given the time of the query, or with strict_timestamps must
+        hold a date or ISO 8601 string instead.
+        """
+        prefix, instance = get_metric_info(service_name)
+
+        db_tzinfo = None
+
+        if timestamp_column is not None and service_name in timezones.keys():
+            db_tzinfo = pytz.timezone(timezones[service_name])
+
+        instance_label = None
+
+        if service_names['push'] or aps.app.config['DEFAULT_PUSH_SERVICE_NAMES']:
+            instance_label = instance
+
+        default_timestamp = None if strict_timestamps else timestamp
+
+        projector = None
+
+        # No further rows are fetched once the limit is reached
+        if collector_metrics.is_full:
+            return
+
+        for row_count, batch, batch_columns in batches:
+            if not row_count:
+                continue
+
+            if projector is None:
+                projector = get_row_projector(job_name, columns, prefix, value_columns, static_labels, timestamp_column, instance_label)
+
+            # Batches which cannot reach the limits are converted column by column
+            if collector_metrics.max_label_values is None and (collector_metrics.max_series is None or collector_metrics.series_count + row_count * len(projector.metric_indexes) < collector_metrics.max_series):
+                if batch_columns is None:
+                    batch_columns = list(zip(*batch))
+
+                label_values_list, metric_values, timestamps = projector.get_columns(batch_columns, row_count, timestamp, db_tzinfo, default_timestamp)
+
+                for metric_name, values in metric_values:
+                    collector_metrics.add_samples(metric_name, projector.label_names, label_values_list, values, timestamps)
+
+                continue
+
+            if batch is None:
+                batch = list(zip(*[column.to_pylist() for column in batch_columns]))
+
+            for n, row in enumerate(batch):
+                row_timestamp = timestamp
+
+                if db_tzinfo is not None:
+                    row_timestamp = to_timestamp(row[projector.timestamp_index], db_tzinfo, default_timestamp)
+
+                label_values = projector.get_label_values(row)
+
+                for metric_name, i in projector.metric_indexes:
+                    collector_metrics.add_sample(metric_name, projector.label_names, label_values, row[i], row_timestamp)
+
+                if collector_metrics.is_full:
+                    # Only the series of rows already fetched are counted as dropped
+                    collector_metrics.dropped_series_count += (len(batch) - n - 1) * len(projector.metric_indexes)
+
+                    aps.app.logger.warning("Job '" + job_name + "' reached its limit of " + str(collector_metrics.max_series) + " series. The series of any remaining fetched rows were dropped, and no further rows were fetched.")
+                    break
+
+            if collector_metrics.is_full:
+                break
+
+    @staticmethod
+    def generate_metrics(*args, **kwargs):
         category = args[0]
         job_name = args[1]
         service_names = args[2]
@@ -672,6 +1085,12 @@ class Metrics:
 
             with aps.app.app_context():
                 try:
+                    if category == 'database' and all(db.get_engine(bind=service_name).dialect.is_async for service_name in service_names['source']):
+                        # Frees the scheduler's worker, rather than holding it while the queries run
+                        Metrics._run_database_job_async(job, args, kwargs)
+
+                        return
+
                     with JOB_EXECUTION_TIME.labels(job_name, category).time():
                         push_services = get_push_services(
                             job_name,
@@ -680,9 +1099,22 @@ class Metrics:
 
                         enforce_timeout = aps.app.config['LIMIT_JOB_EXECUTION_TIME'] and job.next_run_time is not None
 
-                        if enforce_timeout:
-                            # Prevent database jobs with JDBC connections from running under multiprocessing
-                            if category == 'database':
+                        if enforce_timeout and category == 'database':
+                            dal = DatabaseAccessLayer(db)
+
+                            if all(dal.supports_query_timeout(service_name) for service_name in service_names['source']):
+                                # Database jobs are limited by a query timeout applied by the database itself, instead of being killed
+                                end_dt = job.next_run_time
+                                job_tz = pytz.timezone(end_dt.tzname())
+
+                                max_execution_time = max((end_dt - datetime.now(job_tz)).total_seconds() - 1, 1)
+
+                                # Lowers, but never raises, any query timeout of the job or its services
+                                kwargs = dict(kwargs, query_deadline=default_timer() + max_execution_time)
+
+                                enforce_timeout = False
+                            else:
+                                # Prevent database jobs with JDBC connections from running under multiprocessing
                                 for service_name in service_names['source']:
                                     if service_name in aps.app.config['SQLALCHEMY_BINDS'].keys():
                                         bind = aps.app.config['SQLALCHEMY_BINDS'][service_name]
@@ -697,7 +1129,7 @@ class Metrics:
 
                             p = Process(
                                 target=get_metrics,
-                                args=(func, job_name, args[1:], push_services, cconn)
+                                args=(func, job_name, args[1:], push_services, cconn, kwargs)
                             )
 
                             end_dt = job.next_run_time
@@ -725,24 +1157,117 @@ class Metrics:
                             if p.exception is not None:
                                 raise p.exception
                         else:
-                            get_metrics(func, job_name, args[1:], push_services)
+                            get_metrics(func, job_name, args[1:], push_services, kwargs=kwargs)
                 except Exception as e:
-                    exception = e.__class__.__name__
+                    Metrics._handle_job_failure(job_name, category, e)
+
+    @staticmethod
+    def read_all_job_metrics(exposition_format='text', categories=None, labels=None, compress=False, chunk_size=65536):
+        for job_name in get_jobs(categories):
+            exposition = get_job_exposition(job_name)
 
-                    JOB_FAILURES.labels(job_name, category, exception).inc()
+            if exposition is None:
+                continue
 
-                    aps.app.logger.warning("Job '" + job_name + "' failed. " + exception + ": " + str(e))
-                    aps.app.logger.debug(traceback.format_exc())
+            if labels:
+                constant_labels = exposition.registry.get_constant_labels()
 
-                    if aps.app.config['SUSPEND_JOB_ON_FAILURE']:
-                        aps.pause_job(job_name)
+                if not all(constant_labels.get(label_name) == value for label_name, value in labels):
+                    continue
 
-                        aps.app.logger.warning("Job '" + job_name + "' suspended.")
+            if compress:
+                if exposition.streaming:
+                    chunks = compress_chunks(exposition.stream(exposition_format, chunk_size))
+                else:
+                    chunks = iter([exposition.compress(exposition_format)])
+            else:
+                chunks = exposition.stream(exposition_format, chunk_size)
 
-                    unset_job_collector_metrics(job_name)
+            yield from observe_chunks(chunks, JOB_SCRAPE_RENDER_TIME.labels(job_name, exposition_format), JOB_SCRAPE_RESPONSE_SIZE.labels(job_name, exposition_format))
 
     @staticmethod
-    def read_prometheus_metrics(name):
-        registry = get_registry(name)
+    def read_job_metrics(job_name):
+        exposition = get_job_exposition(job_name)
+
+        if exposition is None:
+            exposition = Exposition(get_registry(job_name))
+
+        return exposition
+
+
+class RowProjector:
+    """Maps the columns of a database job's query result to metric samples.
+
+    Metric names, label names and column indexes are resolved once per column set, leaving only indexing to do per row.
+    """
+    def __init__(self, job_name, columns, prefix, value_columns, static_labels=(), timestamp_column=None, instance=None):
+        lower_columns = [column.lower() for column in columns]
+
+        unmatched_value_columns = [column for column in value_columns if column.lower() not in lower_columns]
+
+        if unmatched_value_columns:
+            raise ValueError("Value column(s) " + ", ".join(["'" + column + "'" for column in unmatched_value_columns]) + " specified in job '" + job_name + "' not returned in query result.")
+
+        lower_value_columns = [column.lower() for column in value_columns]
+
+        self.metric_indexes = tuple([
+            ('%s.%s' % (prefix, format_metric(column)), i) for i, column in enumerate(columns) if lower_columns[i] in lower_value_columns
+        ])
+
+        self.timestamp_index = None
+
+        if timestamp_column is not None:
+            for i, column in enumerate(lower_columns):
+                if timestamp_column.lower() == column:
+                    self.timestamp_index = i
+
+            if self.timestamp_index is None:
+                raise ValueError("Timestamp column '" + timestamp_column + "' specified in job '" + job_name + "' not returned in query result.")
+
+        value_column_indexes = [i for metric_name, i in self.metric_indexes]
+
+        # Each label is sourced from a column index, or from a static value where the index is None
+        label_sources = OrderedDict()
+
+        if instance is not None:
+            label_sources['instance'] = (None, instance)
+
+        for i, column in enumerate(columns):
+            if i not in value_column_indexes and i != self.timestamp_index:
+                label_sources[format_label(column)] = (i, None)
+
+        for label, value in static_labels:
+            if format_label(label) not in label_sources.keys():
+                label_sources[format_label(label)] = (None, value)
+
+        self.label_names = tuple(label_sources.keys())
+        self.label_sources = tuple(label_sources.values())
+
+    def get_columns(self, columns, row_count, timestamp, tzinfo=None, default_timestamp=None):
+        """Returns the interned label values of each row, the values of each metric and the timestamps of the rows,
+        given the result's columns as sequences or Arrow arrays; values and timestamps are returned as NumPy arrays.
+
+        Timestamps are taken from the timestamp column, given tzinfo, with default_timestamp for values which are not
+        datetimes (see to_timestamp); otherwise every row is given timestamp.
+        """
+        label_columns = [
+            to_label_column(columns[i]) if i is not None else [intern_label_value(value)] * row_count for i, value in self.label_sources
+        ]
+
+        label_values_list = list(zip(*label_columns)) if label_columns else [()] * row_count
+
+        metric_values = [
+            (metric_name, to_value_column(columns[i])) for metric_name, i in self.metric_indexes
+        ]
+
+        if tzinfo is not None and self.timestamp_index is not None:
+            timestamps = to_timestamp_column(columns[self.timestamp_index], tzinfo, default_timestamp)
+        else:
+            timestamps = numpy.full(row_count, timestamp, dtype=numpy.float64)
+
+        return label_values_list, metric_values, timestamps
 
-        return generate_latest(registry)
+    def get_label_values(self, row):
+        return tuple([
+            to_string(row[i]) if i is not None else value for i, value in self.label_sources
+        ])
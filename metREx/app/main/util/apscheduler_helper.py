@@ -4,6 +4,9 @@ import yaml
 
 import pytz
 
+from .misc_helper import str_to_bool
+from .sqlalchemy_helper import async_drivers, last_timestamp_param_pattern
+
 package_components = __package__.split('.')
 
 package_components.pop()
@@ -28,8 +31,8 @@ def apply_job_templates(jobs, templates):
     return jobs
 
 
-def build_job(category, name, bind, seconds, *args):
-    return {
+def build_job(category, name, bind, seconds, *args, **kwargs):
+    job = {
         'func': job_func_root + '.service.metrics_service:Metrics.generate_metrics',
         'trigger': 'interval',
         'args': (category, name, bind) + args,
@@ -37,6 +40,33 @@ def build_job(category, name, bind, seconds, *args):
         'seconds': seconds
     }
 
+    if kwargs:
+        job['kwargs'] = kwargs
+
+    return job
+
+
+def get_job_limits(job_name, credentials):
+    return get_positive_int_options(job_name, credentials, ['max_series', 'max_label_values'])
+
+
+def get_positive_int_options(job_name, credentials, names):
+    options = {}
+
+    for name in names:
+        if name in credentials.keys():
+            try:
+                value = int(credentials[name])
+            except (TypeError, ValueError):
+                value = 0
+
+            if value < 1:
+                raise ValueError("Invalid value '" + str(credentials[name]) + "' specified for '" + name + "' in job '" + job_name + "'.")
+
+            options[name] = value
+
+    return options
+
 
 def build_job_list(jobs, apialchemy_info, sqlalchemy_info):
     """Builds list of scheduled jobs to assign to SCHEDULER_JOBS"""
@@ -61,6 +91,10 @@ def build_job_list(jobs, apialchemy_info, sqlalchemy_info):
     service_name_pattern = re.compile(r'^' + r'(?:(?:' + re.escape(apialchemy_prefix) + r')|(?:' + re.escape(sqlalchemy_prefix) + r'))(?P<name>.+)$', re.X)
 
     for job_name, credentials in jobs.items():
+        if job_name == 'all':
+            # Reserved for the endpoint which scrapes the metrics of all jobs together
+            raise ValueError("Job ID '" + job_name + "' is reserved.")
+
         for k, v in credentials.items():
             if isinstance(v, str):
                 undefined_env_vars, credentials[k] = populate_env_vars(v)
@@ -74,6 +108,8 @@ def build_job_list(jobs, apialchemy_info, sqlalchemy_info):
                 'push': []
             }
 
+            job_kwargs = get_job_limits(job_name, credentials)
+
             for service in credentials['services']:
                 service_name = get_service_name(job_name, service, service_name_pattern, valid_service_names)
 
@@ -192,10 +228,13 @@ def build_job_list(jobs, apialchemy_info, sqlalchemy_info):
 
                         job_args.append(static_labels)
 
-                    job_list.append(build_job(*job_args))
+                    job_list.append(build_job(*job_args, **job_kwargs))
 
                     continue
             elif all(service_name in sqlalchemy_binds.keys() for service_name in service_names['source']):
+                if len(set(is_async_service(sqlalchemy_binds[service_name]) for service_name in service_names['source'])) > 1:
+                    raise ValueError("Services defined for job '" + job_name + "' must all use async drivers or none.")
+
                 if 'statement' in credentials.keys() and 'value_columns' in credentials.keys():
                     if isinstance(credentials['value_columns'], str):
                         # For backward-compatibility with older versions, which expected comma-delimited string
@@ -238,8 +277,40 @@ def build_job_list(jobs, apialchemy_info, sqlalchemy_info):
                         }
 
                         job_args.append(timezones)
+                    elif last_timestamp_param_pattern.search(credentials['statement']):
+                        raise ValueError("Parameter ':last_timestamp' used in job '" + job_name + "' requires 'timestamp_column'.")
+
+                    job_kwargs.update(get_positive_int_options(job_name, credentials, ['fetch_size', 'parallelism', 'query_timeout']))
+
+                    # Options applied to each query job run on BigQuery
+                    bigquery_options = get_positive_int_options(job_name, credentials, ['maximum_bytes_billed'])
+
+                    if 'use_query_cache' in credentials.keys():
+                        bigquery_options['use_query_cache'] = str_to_bool(credentials['use_query_cache'])
+
+                    use_bqstorage_api = str_to_bool(credentials.get('use_bqstorage_api', False))
+
+                    # Options applied to the cursor of each query run on Oracle
+                    oracle_options = get_positive_int_options(job_name, credentials, ['arraysize', 'prefetchrows'])
 
-                    job_list.append(build_job(*job_args))
+                    dialect_options = [
+                        ('bigquery', 'BigQuery', list(bigquery_options.keys()) + (['use_bqstorage_api'] if use_bqstorage_api else [])),
+                        ('oracle', 'Oracle', list(oracle_options.keys()))
+                    ]
+
+                    for dialect, dialect_name, names in dialect_options:
+                        if names and not all(sqlalchemy_binds[service_name].get('dialect') == dialect for service_name in service_names['source']):
+                            raise ValueError("Option(s) " + ", ".join(["'" + name + "'" for name in names]) + " defined for job '" + job_name + "' require " + dialect_name + " services.")
+
+                    execution_options = {**bigquery_options, **oracle_options}
+
+                    if execution_options:
+                        job_kwargs['execution_options'] = execution_options
+
+                    if use_bqstorage_api:
+                        job_kwargs['use_bqstorage_api'] = True
+
+                    job_list.append(build_job(*job_args, **job_kwargs))
 
                     continue
             else:
@@ -247,6 +318,43 @@ def build_job_list(jobs, apialchemy_info, sqlalchemy_info):
 
         raise ValueError("Missing required credential(s) for job '" + job_name + "'.")
 
+    # Database jobs executing the same statement against the same services at the same interval, with the same options, share its rows
+    query_groups = {}
+
+    for job in job_list:
+        if job['args'][0] == 'database' and 'fetch_size' not in job.get('kwargs', {}).keys():
+            # Jobs on async services run on a single event loop thread, where waiting on another job's query would block it
+            if is_async_service(sqlalchemy_binds[job['args'][2]['source'][0]]):
+                continue
+
+            # Jobs querying rows after those they already collected each query from a point of their own
+            if last_timestamp_param_pattern.search(job['args'][3]):
+                continue
+
+            job_kwargs = job.get('kwargs', {})
+
+            # Shared queries are run with the options of whichever job runs first, so only jobs with the same options share
+            key = (tuple(job['args'][2]['source']), job['args'][3], job['seconds'], job_kwargs.get('query_timeout'), job_kwargs.get('use_bqstorage_api', False), tuple(sorted(job_kwargs.get('execution_options', {}).items())))
+
+            if key not in query_groups.keys():
+                query_groups[key] = []
+
+            query_groups[key].append(job)
+
+    for jobs in query_groups.values():
+        if len(jobs) > 1:
+            query_group = {
+                'name': jobs[0]['id'],
+                'interval': jobs[0]['seconds'],
+                'size': len(jobs)
+            }
+
+            for job in jobs:
+                if 'kwargs' not in job.keys():
+                    job['kwargs'] = {}
+
+                job['kwargs']['query_group'] = query_group
+
     return job_list
 
 
@@ -376,6 +484,10 @@ def get_services_from_yaml(yaml_data):
     return services
 
 
+def is_async_service(credentials):
+    return credentials.get('driver') in async_drivers
+
+
 def populate_env_vars(string):
     undefined_env_vars = []
 
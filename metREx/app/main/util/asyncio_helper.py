@@ -0,0 +1,50 @@
+import asyncio
+
+from threading import Lock, Thread
+
+
+class EventLoopThread:
+    """An asyncio event loop run by a daemon thread, which is started when the first coroutine is submitted.
+
+    Coroutines can be submitted from any thread, and are counted by key until they are done.
+    """
+    def __init__(self, name='EventLoop'):
+        self._name = name
+        self._loop = None
+        self._running = {}
+        self._lock = Lock()
+
+    def _done(self, key):
+        with self._lock:
+            self._running[key] -= 1
+
+            if not self._running[key]:
+                del self._running[key]
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+
+                Thread(target=self._loop.run_forever, name=self._name, daemon=True).start()
+
+            return self._loop
+
+    def get_running_count(self, key):
+        with self._lock:
+            return self._running.get(key, 0)
+
+    def submit(self, coro, key=None):
+        """Schedules the coroutine on the event loop and returns a concurrent.futures.Future of its result."""
+        loop = self._get_loop()
+
+        with self._lock:
+            self._running[key] = self._running.get(key, 0) + 1
+
+        async def _run():
+            try:
+                return await coro
+            finally:
+                self._done(key)
+
+        return asyncio.run_coroutine_threadsafe(_run(), loop)
@@ -1,12 +1,30 @@
-from flask import make_response
+from flask import make_response, request
 
 
-def format_response(data, content_type):
-    response = make_response(data)
+def accepts_gzip():
+    return request.accept_encodings['gzip'] > 0
 
-    response.headers['Content-Type'] = content_type
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
+
+def format_response(data, content_type, content_encoding=None, etag=None):
+    if etag is not None and request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(data)
+
+        response.headers['Content-Type'] = content_type
+
+        if content_encoding is not None:
+            response.headers['Content-Encoding'] = content_encoding
+
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+
+    if etag is not None:
+        response.set_etag(etag)
+
+        response.headers['Cache-Control'] = 'no-cache'
+    else:
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
 
     return response
@@ -0,0 +1,155 @@
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+from urllib import parse
+
+# Stored files begin with the magic bytes, the SHA-256 hex digest of the payload and the length-prefixed
+# JSON of the job's constant labels, followed by the payload (the job metrics in Prometheus text format)
+file_magic = b'METREX01'
+header_format = '<8s64sI'
+header_size = struct.calcsize(header_format)
+
+result_store_dir = os.getenv('RESULT_STORE_DIR')
+
+
+class StoredExposition:
+    """Job metrics read from a memory-mapped result store file.
+
+    The payload is served from the mapping, or directly from the file, without being loaded into memory.
+    """
+    formats = ('text',)
+    streaming = False
+
+    def __init__(self, path):
+        self._path = path
+
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, etag, labels_size = struct.unpack_from(header_format, self._mmap)
+
+        if magic != file_magic:
+            raise ValueError("Invalid result store file '" + path + "'.")
+
+        self._etag = etag.decode('ascii')
+        self._constant_labels = json.loads(self._mmap[header_size:header_size + labels_size].decode('utf-8'))
+        self._offset = header_size + labels_size
+
+        self._gzip_data = None
+
+    def compress(self, exposition_format='text'):
+        if self._gzip_data is None:
+            self._gzip_data = gzip.compress(self.render(exposition_format), compresslevel=6)
+
+        return self._gzip_data
+
+    def get_constant_labels(self):
+        return self._constant_labels
+
+    def get_etag(self, exposition_format='text'):
+        return self._etag
+
+    def open(self):
+        """Returns the file positioned at the start of the payload, for sending with wsgi.file_wrapper."""
+        f = open(self._path, 'rb')
+        f.seek(self._offset)
+
+        return f
+
+    @property
+    def registry(self):
+        return self
+
+    @property
+    def size(self):
+        return len(self._mmap) - self._offset
+
+    def render(self, exposition_format='text'):
+        return self._mmap[self._offset:]
+
+    def stream(self, exposition_format='text', chunk_size=65536):
+        for i in range(self._offset, len(self._mmap), chunk_size):
+            yield self._mmap[i:i + chunk_size]
+
+
+class ResultStore:
+    """Directory of memory-mapped job metrics, written by the scheduler process and read by any number of workers."""
+    def __init__(self, path):
+        self._path = path
+        self._expositions = {}
+
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+
+    def _get_file_path(self, name):
+        return os.path.join(self._path, parse.quote(name, safe='') + '.prom')
+
+    def clear(self):
+        for filename in os.listdir(self._path):
+            if filename.endswith('.prom'):
+                os.remove(os.path.join(self._path, filename))
+
+    def delete(self, name):
+        try:
+            os.remove(self._get_file_path(name))
+        except FileNotFoundError:
+            pass
+
+    def read(self, name):
+        """Returns the stored exposition for name, re-mapping the file only if it was replaced since the last read."""
+        path = self._get_file_path(name)
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            # Unmaps the file of a deleted job once no longer referenced
+            self._expositions.pop(name, None)
+
+            return None
+
+        version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+        if name not in self._expositions.keys() or self._expositions[name][0] != version:
+            self._expositions[name] = (version, StoredExposition(path))
+
+        return self._expositions[name][1]
+
+    def write(self, name, chunks, constant_labels):
+        """Writes the chunks of text exposition for name, replacing any previous file atomically."""
+        labels = json.dumps(constant_labels).encode('utf-8')
+
+        fd, tmp_path = tempfile.mkstemp(dir=self._path, prefix='.', suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(struct.pack(header_format, file_magic, b'0' * 64, len(labels)))
+                f.write(labels)
+
+                digest = hashlib.sha256()
+
+                for chunk in chunks:
+                    digest.update(chunk)
+
+                    f.write(chunk)
+
+                f.seek(0)
+                f.write(struct.pack(header_format, file_magic, digest.hexdigest().encode('ascii'), len(labels)))
+
+            os.replace(tmp_path, self._get_file_path(name))
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+            raise e
+
+
+__all__ = [
+    'result_store_dir',
+    'ResultStore',
+    'StoredExposition'
+]
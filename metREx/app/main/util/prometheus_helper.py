@@ -1,13 +1,86 @@
+import gzip
+import hashlib
 import os
+import zlib
 
+from collections import OrderedDict
+from timeit import default_timer
+
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 from prometheus_client.core import CollectorRegistry
 from prometheus_client.multiprocess import MultiProcessCollector
+from prometheus_client.openmetrics import exposition as openmetrics
+
+from . import protobuf_helper as protobuf
 
 collector_registries = {}
 
+# Exposition formats in order of preference, each with its content type and encoder
+exposition_formats = OrderedDict([
+    ('protobuf', (protobuf.CONTENT_TYPE_LATEST, protobuf.generate_latest)),
+    ('openmetrics', (openmetrics.CONTENT_TYPE_LATEST, openmetrics.generate_latest)),
+    ('text', (CONTENT_TYPE_LATEST, generate_latest))
+])
+
 prometheus_multiproc_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
 
 
+def choose_exposition_format(accept_header, formats=tuple(exposition_formats.keys())):
+    """Returns the name of the exposition format in formats which best matches the Accept header."""
+    best_format = 'text'
+    best_quality = 0.0
+
+    for media_range in (accept_header or '').split(','):
+        params = [param.strip() for param in media_range.split(';')]
+
+        media_type = params.pop(0).lower()
+
+        param_dict = {}
+
+        for param in params:
+            if '=' in param:
+                key, value = param.split('=', 1)
+
+                param_dict[key.strip().lower()] = value.strip().strip('"')
+
+        try:
+            quality = float(param_dict.get('q', 1))
+        except ValueError:
+            quality = 0.0
+
+        if media_type == 'application/vnd.google.protobuf':
+            if param_dict.get('proto') != 'io.prometheus.client.MetricFamily' or param_dict.get('encoding') != 'delimited':
+                continue
+
+            exposition_format = 'protobuf'
+        elif media_type == 'application/openmetrics-text':
+            exposition_format = 'openmetrics'
+        elif media_type in ['text/plain', 'text/*', '*/*']:
+            exposition_format = 'text'
+        else:
+            continue
+
+        if exposition_format in formats and quality > 0:
+            if quality > best_quality or (quality == best_quality and formats.index(exposition_format) < formats.index(best_format)):
+                best_format = exposition_format
+                best_quality = quality
+
+    return best_format
+
+
+def compress_chunks(chunks):
+    """Yields the chunks as a single gzip stream, compressed as they are produced."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
 def get_registry(name):
     if name not in collector_registries.keys():
         collector_registries[name] = CollectorRegistry()
@@ -23,6 +96,30 @@ def get_registry(name):
     return collector_registries[name]
 
 
+def observe_chunks(chunks, render_time, response_size):
+    """Yields the chunks, observing the time spent producing them and their total size once they have been sent."""
+    duration = 0.0
+    size = 0
+
+    try:
+        while True:
+            start_time = default_timer()
+
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+            finally:
+                duration += default_timer() - start_time
+
+            size += len(chunk)
+
+            yield chunk
+    finally:
+        render_time.observe(duration)
+        response_size.observe(size)
+
+
 def register_collector(name, collector):
     job_registry = get_registry(name)
 
@@ -34,3 +131,61 @@ def unregister_collector(name, collector):
         collector_registries[name].unregister(collector)
 
         del collector_registries[name]
+
+
+class Exposition:
+    """Metrics rendered once per exposition format, with ETags and gzip-compressed copies produced on first use.
+
+    Streaming expositions are never held rendered in memory; they are rendered in chunks by stream() instead, as
+    Prometheus text only, since each protobuf metric family must be encoded whole.
+    """
+    def __init__(self, registry, streaming=False, data=None):
+        self._registry = registry
+        self._streaming = streaming
+
+        self._data = dict(data or {})
+        self._etags = {}
+        self._gzip_data = {}
+
+    @property
+    def formats(self):
+        if self._streaming:
+            return 'text',
+
+        return tuple(exposition_formats.keys())
+
+    @property
+    def registry(self):
+        return self._registry
+
+    @property
+    def streaming(self):
+        return self._streaming
+
+    def compress(self, exposition_format='text'):
+        if exposition_format not in self._gzip_data.keys():
+            self._gzip_data[exposition_format] = gzip.compress(self.render(exposition_format), compresslevel=6)
+
+        return self._gzip_data[exposition_format]
+
+    def get_etag(self, exposition_format='text'):
+        if exposition_format not in self._etags.keys():
+            self._etags[exposition_format] = hashlib.sha256(self.render(exposition_format)).hexdigest()
+
+        return self._etags[exposition_format]
+
+    def render(self, exposition_format='text'):
+        if exposition_format not in self._data.keys():
+            content_type, encoder = exposition_formats[exposition_format]
+
+            self._data[exposition_format] = encoder(self._registry)
+
+        return self._data[exposition_format]
+
+    def stream(self, exposition_format='text', chunk_size=65536):
+        if not self._streaming:
+            yield self.render(exposition_format)
+        elif exposition_format == 'text':
+            yield from self._registry.generate_text_chunks(chunk_size)
+        else:
+            raise ValueError("Exposition format '" + exposition_format + "' cannot be streamed.")
@@ -0,0 +1,80 @@
+import struct
+
+CONTENT_TYPE_LATEST = 'application/vnd.google.protobuf; proto=io.prometheus.client.MetricFamily; encoding=delimited'
+
+# Field numbers and enum values from the io.prometheus.client metrics.proto definitions
+metric_types = {
+    'gauge': 1,
+    'unknown': 3,
+    'untyped': 3
+}
+
+metric_value_fields = {
+    'gauge': 2,
+    'unknown': 5,
+    'untyped': 5
+}
+
+
+def encode_varint(n):
+    n &= 0xFFFFFFFFFFFFFFFF
+
+    data = bytearray()
+
+    while n > 0x7F:
+        data.append((n & 0x7F) | 0x80)
+        n >>= 7
+
+    data.append(n)
+
+    return bytes(data)
+
+
+def encode_double_field(field, value):
+    return encode_varint(field << 3 | 1) + struct.pack('<d', float(value))
+
+
+def encode_message_field(field, data):
+    return encode_varint(field << 3 | 2) + encode_varint(len(data)) + data
+
+
+def encode_string_field(field, string):
+    return encode_message_field(field, string.encode('utf-8'))
+
+
+def encode_varint_field(field, n):
+    return encode_varint(field << 3) + encode_varint(n)
+
+
+def encode_metric_family(metric):
+    if metric.type not in metric_types.keys():
+        raise ValueError("Unsupported metric type '" + metric.type + "' for protobuf exposition of metric '" + metric.name + "'.")
+
+    data = [
+        encode_string_field(1, metric.name),
+        encode_string_field(2, metric.documentation),
+        encode_varint_field(3, metric_types[metric.type])
+    ]
+
+    for s in metric.samples:
+        metric_data = [
+            encode_message_field(1, encode_string_field(1, name) + encode_string_field(2, value)) for name, value in s.labels.items()
+        ]
+
+        metric_data.append(encode_message_field(metric_value_fields[metric.type], encode_double_field(1, s.value)))
+
+        if s.timestamp is not None:
+            metric_data.append(encode_varint_field(6, int(float(s.timestamp) * 1000)))
+
+        data.append(encode_message_field(4, b''.join(metric_data)))
+
+    message = b''.join(data)
+
+    return encode_varint(len(message)) + message
+
+
+def generate_latest(registry):
+    """Returns the metrics from the registry in length-delimited protobuf format."""
+    return b''.join([
+        encode_metric_family(metric) for metric in registry.collect()
+    ])
@@ -0,0 +1,304 @@
+import json
+import sys
+
+from array import array
+
+import numpy
+
+from prometheus_client.utils import floatToGoString
+
+
+def escape_label_value(value):
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_sample_value(value, timestamp, use_timestamp):
+    if use_timestamp:
+        return '%s %d\n' % (floatToGoString(value), int(timestamp * 1000))
+
+    return floatToGoString(value) + '\n'
+
+
+def format_text_header(name):
+    return '# HELP %s \n# TYPE %s gauge\n' % (name, name)
+
+
+def intern_label_value(value):
+    return sys.intern(value if isinstance(value, str) else str(value))
+
+
+def intern_label_values(label_values):
+    return tuple(intern_label_value(label_value) for label_value in label_values)
+
+
+def to_float(value):
+    return float(value) if value is not None else float('nan')
+
+
+class MetricSamples:
+    """Samples for a single metric, stored as parallel arrays sharing one tuple of label names."""
+    def __init__(self, label_names):
+        self.label_names = tuple(label_names)
+        self.label_values = []
+        self.values = array('d')
+        self.timestamps = array('d')
+
+        self._index = {}
+
+    def __contains__(self, label_values):
+        return tuple(label_values) in self._index.keys()
+
+    def __iter__(self):
+        return zip(self.label_values, self.values, self.timestamps)
+
+    def __len__(self):
+        return len(self.label_values)
+
+    def append(self, label_values, value, timestamp):
+        """Adds a sample for interned label values not already present."""
+        self._index[label_values] = len(self.label_values)
+
+        self.label_values.append(label_values)
+        self.values.append(to_float(value))
+        self.timestamps.append(timestamp)
+
+    def extend(self, label_values_list, values, timestamps):
+        """Adds samples for interned label values not already present, given values and timestamps as NumPy arrays;
+        returns the number added."""
+        start = len(self.label_values)
+
+        indexes = []
+
+        for i, label_values in enumerate(label_values_list):
+            if label_values not in self._index.keys():
+                self._index[label_values] = start + len(indexes)
+
+                indexes.append(i)
+
+        if len(indexes) < len(label_values_list):
+            label_values_list = [label_values_list[i] for i in indexes]
+            values = values[indexes]
+            timestamps = timestamps[indexes]
+
+        self.label_values.extend(label_values_list)
+        self.values.frombytes(numpy.asarray(values, dtype=numpy.float64).tobytes())
+        self.timestamps.frombytes(numpy.asarray(timestamps, dtype=numpy.float64).tobytes())
+
+        return len(indexes)
+
+    def format_series(self, name, label_order, label_values):
+        """Returns the metric name and labels which begin the text line of a series."""
+        if label_order:
+            return name + '{' + ','.join([
+                '%s="%s"' % (self.label_names[i], escape_label_value(label_values[i])) for i in label_order
+            ]) + '} '
+
+        return name + ' '
+
+    def generate_text_lines(self, name, use_timestamp):
+        """Yields the samples as gauge lines in the Prometheus text format, as generate_latest renders them."""
+        yield format_text_header(name)
+
+        label_order = self.get_label_order()
+
+        for label_values, value, timestamp in self:
+            yield self.format_series(name, label_order, label_values) + format_sample_value(value, timestamp, use_timestamp)
+
+    def get_constant_labels(self):
+        """Returns the labels which have the same value for every sample."""
+        constant_labels = {}
+
+        for i, label_name in enumerate(self.label_names):
+            values = set([label_values[i] for label_values in self.label_values])
+
+            if len(values) == 1:
+                constant_labels[label_name] = values.pop()
+
+        return constant_labels
+
+    def get_label_order(self):
+        """Returns the label indexes in the order of their sorted names, as text exposition expects."""
+        return sorted(range(len(self.label_names)), key=self.label_names.__getitem__)
+
+    def get_label_value(self, label_name, i=0):
+        if label_name in self.label_names and i < len(self.label_values):
+            return self.label_values[i][self.label_names.index(label_name)]
+
+        return None
+
+    def to_dict(self):
+        """Returns samples keyed by JSON-encoded label data, as expected by push service clients."""
+        return {
+            json.dumps(dict(zip(self.label_names, label_values))): (value, timestamp) for label_values, value, timestamp in self
+        }
+
+
+class CollectorMetrics(dict):
+    """Samples collected by a job run, keyed by metric name and optionally limited in cardinality.
+
+    Samples are dropped once max_series series are stored, or if they would give any label more than
+    max_label_values distinct values.
+    """
+    def __init__(self, max_series=None, max_label_values=None):
+        super(CollectorMetrics, self).__init__()
+
+        self.max_series = max_series
+        self.max_label_values = max_label_values
+
+        self.series_count = 0
+        self.dropped_series_count = 0
+
+        self._label_value_sets = {}
+        self._kept_series = set()
+
+    @property
+    def is_full(self):
+        return self.max_series is not None and self.series_count >= self.max_series
+
+    def add_sample(self, metric_name, label_names, label_values, value, timestamp):
+        """Adds a sample unless it is a duplicate or exceeds the limits; returns whether it was added."""
+        label_values = intern_label_values(label_values)
+
+        if metric_name in self.keys() and label_values in self[metric_name]:
+            return False
+
+        if self.is_full:
+            self.dropped_series_count += 1
+
+            return False
+
+        if self.max_label_values is not None:
+            new_label_values = [
+                (label_name, label_value) for label_name, label_value in zip(label_names, label_values) if label_value not in self._label_value_sets.get(label_name, ())
+            ]
+
+            for label_name, label_value in new_label_values:
+                if len(self._label_value_sets.get(label_name, ())) >= self.max_label_values:
+                    self.dropped_series_count += 1
+
+                    return False
+
+            for label_name, label_value in new_label_values:
+                self._label_value_sets.setdefault(label_name, set()).add(label_value)
+
+        if metric_name not in self.keys():
+            self[metric_name] = MetricSamples(label_names)
+
+        self[metric_name].append(label_values, value, timestamp)
+
+        self.series_count += 1
+
+        return True
+
+    def keep_sample(self, metric_name, label_names, label_values, value, timestamp):
+        """Adds a sample kept from an earlier run unless its series was collected again; returns whether it was added.
+        Kept samples are neither subject to nor counted against the limits."""
+        label_values = intern_label_values(label_values)
+
+        if metric_name in self.keys() and label_values in self[metric_name]:
+            return False
+
+        if metric_name not in self.keys():
+            self[metric_name] = MetricSamples(label_names)
+
+        self[metric_name].append(label_values, value, timestamp)
+
+        self._kept_series.add((metric_name, label_values))
+
+        return True
+
+    def add_samples(self, metric_name, label_names, label_values_list, values, timestamps):
+        """Adds samples in bulk, given interned label values and NumPy arrays of values and timestamps; returns the number
+        added. The caller must ensure that the samples cannot exceed the limits."""
+        if metric_name not in self.keys():
+            self[metric_name] = MetricSamples(label_names)
+
+        added_count = self[metric_name].extend(label_values_list, values, timestamps)
+
+        self.series_count += added_count
+
+        return added_count
+
+    def merge(self, collector_metrics):
+        """Adds the samples of another instance, subject to the limits of this one."""
+        self.dropped_series_count += collector_metrics.dropped_series_count
+
+        for metric_name, samples in collector_metrics.items():
+            for label_values, value, timestamp in samples:
+                if (metric_name, label_values) in collector_metrics._kept_series:
+                    self.keep_sample(metric_name, samples.label_names, label_values, value, timestamp)
+                else:
+                    self.add_sample(metric_name, samples.label_names, label_values, value, timestamp)
+
+
+class TextLineCache:
+    """Text lines rendered for each series of a job, reused by later runs for series which have not changed."""
+    def __init__(self):
+        self._series = {}
+
+    def render(self, collector_metrics, use_timestamp):
+        """Returns the metrics in the Prometheus text format and the number of series changed since the last render."""
+        output = []
+        series = {}
+        changed_count = 0
+
+        for metric_name, samples in collector_metrics.items():
+            name = metric_name.replace('.', '_')
+
+            label_names, previous_lines = self._series.get(metric_name, (None, {}))
+
+            if label_names != samples.label_names:
+                previous_lines = {}
+
+            label_order = samples.get_label_order()
+
+            lines = {}
+            matched_count = 0
+            unchanged_count = 0
+
+            output.append(format_text_header(name))
+
+            for label_values, value, timestamp in samples:
+                previous = previous_lines.get(label_values)
+
+                if previous is not None:
+                    matched_count += 1
+
+                    prefix, previous_value, previous_timestamp, line = previous
+
+                    # NaN values never compare equal, so they are matched separately
+                    same_value = value == previous_value or (value != value and previous_value != previous_value)
+
+                    if same_value and (not use_timestamp or timestamp == previous_timestamp):
+                        lines[label_values] = previous
+                        output.append(line)
+
+                        unchanged_count += 1
+                        continue
+                else:
+                    prefix = samples.format_series(name, label_order, label_values)
+
+                line = prefix + format_sample_value(value, timestamp, use_timestamp)
+
+                lines[label_values] = (prefix, value, timestamp, line)
+                output.append(line)
+
+            # Series added or updated in this render, plus those no longer returned
+            changed_count += len(lines) - unchanged_count + len(previous_lines) - matched_count
+
+            series[metric_name] = (samples.label_names, lines)
+
+        for metric_name, (label_names, previous_lines) in self._series.items():
+            if metric_name not in series.keys():
+                changed_count += len(previous_lines)
+
+        self._series = series
+
+        return ''.join(output).encode('utf-8'), changed_count
+
+
+__all__ = [
+    'CollectorMetrics',
+    'MetricSamples',
+    'TextLineCache'
+]
@@ -1,14 +1,36 @@
 import json
 import re
 
+from datetime import datetime
 from urllib import parse
 
 import pytz
 
 from cryptofy import encoding, decrypt
 
+from sqlalchemy.pool import NullPool, QueuePool, SingletonThreadPool, StaticPool
+
 from .misc_helper import str_to_bool
 
+async_drivers = [
+    'aiomysql',
+    'aiosqlite',
+    'asyncpg'
+]
+
+# Bind parameter of statements querying only the rows after those already collected, as text() parses bind parameters
+last_timestamp_param_pattern = re.compile(r'(?<![:\w\\]):last_timestamp(?!\w)')
+
+# Bound to the parameter until rows have been collected
+last_timestamp_default = datetime(1970, 1, 1)
+
+pool_classes = {
+    'NullPool': NullPool,
+    'QueuePool': QueuePool,
+    'SingletonThreadPool': SingletonThreadPool,
+    'StaticPool': StaticPool
+}
+
 
 def build_bind_dict(binds, key=''):
     """Builds dict of connections to assign to SQLALCHEMY_BINDS"""
@@ -34,6 +56,92 @@ def build_bind_dict(binds, key=''):
     return bind_dict
 
 
+def build_engine_options_dict(binds):
+    """Builds dict of engine options for each connection to assign to SQLALCHEMY_BINDS_ENGINE_OPTIONS"""
+    engine_options_dict = {}
+
+    for name, credentials in binds.items():
+        options = {}
+
+        if 'pool_class' in credentials.keys():
+            if credentials['pool_class'] not in pool_classes.keys():
+                raise ValueError("Unsupported pool class '" + str(credentials['pool_class']) + "' defined for service '" + name + "'.")
+
+            options['poolclass'] = pool_classes[credentials['pool_class']]
+
+        for option in ['pool_size', 'max_overflow', 'pool_recycle', 'pool_timeout', 'query_timeout']:
+            if option in credentials.keys():
+                try:
+                    options[option] = int(credentials[option])
+                except (TypeError, ValueError):
+                    raise ValueError("Invalid value '" + str(credentials[option]) + "' specified for '" + option + "' in service '" + name + "'.")
+
+        if 'pool_pre_ping' in credentials.keys():
+            options['pool_pre_ping'] = str_to_bool(credentials['pool_pre_ping'])
+
+        execution_options = {}
+
+        if 'share_connection' in credentials.keys():
+            # Read by the metrics service, which runs the jobs due at the same time on one connection
+            execution_options['share_connection'] = str_to_bool(credentials['share_connection'])
+
+        if 'query_timeout' in options.keys():
+            query_timeout = options.pop('query_timeout')
+
+            if query_timeout < 1:
+                raise ValueError("Invalid value '" + str(credentials['query_timeout']) + "' specified for 'query_timeout' in service '" + name + "'.")
+
+            # Applied by the database access layer to each statement run on the connection
+            execution_options['query_timeout'] = query_timeout
+
+            if credentials.get('dialect') == 'mssql' and credentials.get('driver', 'pymssql') == 'pymssql':
+                options['connect_args'] = {
+                    'timeout': query_timeout
+                }
+
+        if execution_options:
+            options['execution_options'] = execution_options
+
+        if str_to_bool(credentials.get('session_pool', False)):
+            if credentials.get('dialect') != 'oracle':
+                raise ValueError("Option 'session_pool' defined for service '" + name + "' requires an Oracle database.")
+
+            # Passed to the Oracle dialect, which acquires sessions from a cx_Oracle session pool
+            session_pool = {
+                'min': 1,
+                'max': 4,
+                'increment': 1
+            }
+
+            for option in ['min', 'max', 'increment']:
+                if 'session_pool_' + option in credentials.keys():
+                    try:
+                        session_pool[option] = int(credentials['session_pool_' + option])
+                    except (TypeError, ValueError):
+                        raise ValueError("Invalid value '" + str(credentials['session_pool_' + option]) + "' specified for 'session_pool_" + option + "' in service '" + name + "'.")
+
+            options['session_pool'] = session_pool
+
+        if 'drcp_connection_class' in credentials.keys():
+            if credentials.get('dialect') != 'oracle':
+                raise ValueError("Option 'drcp_connection_class' defined for service '" + name + "' requires an Oracle database.")
+
+            # Passed to the Oracle dialect, which connects or acquires sessions with the class, with or without a session pool
+            options['drcp_connection_class'] = credentials['drcp_connection_class']
+
+        if 'poolclass' not in options.keys() and any(option in options.keys() for option in ['pool_size', 'max_overflow', 'pool_timeout']):
+            options['poolclass'] = QueuePool
+
+        if options.get('poolclass', NullPool) is not NullPool:
+            # Connections are reused, so any open transaction must end when each is returned to the pool
+            options['pool_reset_on_return'] = 'rollback'
+
+        if options:
+            engine_options_dict[name] = options
+
+    return engine_options_dict
+
+
 def build_dsn(credentials):
     """Constructs SQLAlchemy DSN string from credentials."""
     dialect_driver = [credentials['dialect']]
@@ -135,6 +243,10 @@ def build_dsn(credentials):
                     service_name=credentials['name']
                 ))
 
+                if 'drcp_connection_class' in credentials.keys():
+                    # Connects to a pooled server process of Database Resident Connection Pooling (DRCP)
+                    dsn = dsn.replace('(CONNECT_DATA=', '(CONNECT_DATA=(SERVER=POOLED)', 1)
+
                 base.append(dsn)
             else:
                 hostname_port_database = [':'.join(hostname_port)]
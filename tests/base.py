@@ -7,6 +7,15 @@ from flask_testing import TestCase
 from metREx.app.main import *
 
 
+def get_sample_value(metric, name, **labels):
+    for family in metric.collect():
+        for sample in family.samples:
+            if sample.name == name and sample.labels == labels:
+                return sample.value
+
+    return 0.0
+
+
 class BaseTestCase(TestCase):
     __metaclass__ = ABCMeta
 
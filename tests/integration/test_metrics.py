@@ -1,7 +1,8 @@
+import gzip
 import secrets
 import unittest
 
-from ..base import BaseTestCase, get_jobs
+from ..base import BaseTestCase, get_jobs, get_sample_value, JOB_SCRAPE_RENDER_TIME, JOB_SCRAPE_RESPONSE_SIZE
 
 
 def get_application_metrics(client):
@@ -11,10 +12,11 @@ def get_application_metrics(client):
     )
 
 
-def get_job_metrics(client, job_id):
+def get_job_metrics(client, job_id, headers=None):
     return client.get(
         '/metrics/' + job_id,
-        content_type='application/json'
+        content_type='application/json',
+        headers=headers
     )
 
 
@@ -38,6 +40,69 @@ class TestMetricsBlueprint(BaseTestCase):
 
                 self.assertEqual(response.status_code, 200)
 
+    def test_get_job_metrics_gzip(self):
+        jobs = get_jobs()
+
+        for job_id in jobs:
+            with self.client:
+                response = get_job_metrics(self.client, job_id)
+
+                identity_data = response.data
+
+                response = get_job_metrics(self.client, job_id, headers={'Accept-Encoding': 'gzip'})
+
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+                self.assertEqual(gzip.decompress(response.data), identity_data)
+
+    def test_get_job_metrics_not_modified(self):
+        jobs = get_jobs()
+
+        for job_id in jobs:
+            with self.client:
+                response = get_job_metrics(self.client, job_id)
+
+                etag = response.headers['ETag']
+
+                response = get_job_metrics(self.client, job_id, headers={'If-None-Match': etag})
+
+                self.assertEqual(response.status_code, 304)
+
+    def test_get_job_metrics_observed(self):
+        jobs = get_jobs()
+
+        for job_id in jobs:
+            count = get_sample_value(JOB_SCRAPE_RESPONSE_SIZE, 'metrex_job_scrape_response_bytes_count', job=job_id, format='text')
+
+            with self.client:
+                response = get_job_metrics(self.client, job_id)
+
+                self.assertEqual(response.status_code, 200)
+
+            self.assertEqual(get_sample_value(JOB_SCRAPE_RESPONSE_SIZE, 'metrex_job_scrape_response_bytes_count', job=job_id, format='text'), count + 1)
+            self.assertEqual(get_sample_value(JOB_SCRAPE_RENDER_TIME, 'metrex_job_scrape_render_seconds_count', job=job_id, format='text'), count + 1)
+
+    def test_get_job_metrics_openmetrics(self):
+        jobs = get_jobs()
+
+        for job_id in jobs:
+            with self.client:
+                response = get_job_metrics(self.client, job_id, headers={'Accept': 'application/openmetrics-text; version=1.0.0,text/plain;version=0.0.4;q=0.5'})
+
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.headers['Content-Type'].startswith('application/openmetrics-text'))
+                self.assertTrue(response.data.endswith(b'# EOF\n'))
+
+    def test_get_job_metrics_protobuf(self):
+        jobs = get_jobs()
+
+        for job_id in jobs:
+            with self.client:
+                response = get_job_metrics(self.client, job_id, headers={'Accept': 'application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;encoding=delimited;q=0.7,text/plain;version=0.0.4;q=0.3'})
+
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.headers['Content-Type'].startswith('application/vnd.google.protobuf'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,7 +2,11 @@ import unittest
 
 from flask import current_app
 
+from sqlalchemy.pool import QueuePool, StaticPool
+
 from ..base import BaseTestCase
+from metREx.app.main.util.apscheduler_helper import build_job_list
+from metREx.app.main.util.sqlalchemy_helper import build_engine_options_dict
 
 
 class TestDevelopmentConfig(BaseTestCase):
@@ -45,5 +49,243 @@ class TestProductionConfig(BaseTestCase):
         self.assertFalse(self.app.config['SCHEDULER_API_ENABLED'])
 
 
+class TestEngineOptions(unittest.TestCase):
+    def test_build_engine_options_dict(self):
+        binds = {
+            'DEFAULT': {
+                'dialect': 'sqlite'
+            },
+            'POOLED': {
+                'dialect': 'postgresql',
+                'pool_size': '5',
+                'max_overflow': 2,
+                'pool_recycle': 3600,
+                'pool_pre_ping': 'false'
+            },
+            'STATIC': {
+                'dialect': 'sqlite',
+                'pool_class': 'StaticPool'
+            }
+        }
+
+        engine_options_dict = build_engine_options_dict(binds)
+
+        self.assertNotIn('DEFAULT', engine_options_dict.keys())
+        self.assertEqual(engine_options_dict['POOLED'], {
+            'poolclass': QueuePool,
+            'pool_size': 5,
+            'max_overflow': 2,
+            'pool_recycle': 3600,
+            'pool_pre_ping': False,
+            'pool_reset_on_return': 'rollback'
+        })
+        self.assertIs(engine_options_dict['STATIC']['poolclass'], StaticPool)
+
+        engine_options_dict = build_engine_options_dict({
+            'MSSQL': {
+                'dialect': 'mssql',
+                'query_timeout': '30'
+            }
+        })
+
+        self.assertEqual(engine_options_dict['MSSQL'], {
+            'execution_options': {
+                'query_timeout': 30
+            },
+            'connect_args': {
+                'timeout': 30
+            }
+        })
+
+        engine_options_dict = build_engine_options_dict({
+            'ORACLE': {
+                'dialect': 'oracle',
+                'session_pool': 'true',
+                'session_pool_max': '8',
+                'drcp_connection_class': 'METREX'
+            }
+        })
+
+        self.assertEqual(engine_options_dict['ORACLE'], {
+            'session_pool': {
+                'min': 1,
+                'max': 8,
+                'increment': 1
+            },
+            'drcp_connection_class': 'METREX'
+        })
+
+        engine_options_dict = build_engine_options_dict({
+            'ORACLE': {
+                'dialect': 'oracle',
+                'drcp_connection_class': 'METREX'
+            }
+        })
+
+        self.assertEqual(engine_options_dict['ORACLE'], {
+            'drcp_connection_class': 'METREX'
+        })
+
+        with self.assertRaises(ValueError):
+            build_engine_options_dict({'INVALID': {'dialect': 'postgresql', 'drcp_connection_class': 'METREX'}})
+
+        with self.assertRaises(ValueError):
+            build_engine_options_dict({'INVALID': {'dialect': 'postgresql', 'session_pool': 'true'}})
+
+        with self.assertRaises(ValueError):
+            build_engine_options_dict({'INVALID': {'pool_class': 'OtherPool'}})
+
+        with self.assertRaises(ValueError):
+            build_engine_options_dict({'INVALID': {'query_timeout': 0}})
+
+        with self.assertRaises(ValueError):
+            build_engine_options_dict({'INVALID': {'pool_size': 'five'}})
+
+
+class TestJobList(unittest.TestCase):
+    def test_build_job_list_query_groups(self):
+        job = {
+            'services': ['DB_TEST'],
+            'interval_minutes': 1,
+            'statement': 'SELECT 1 AS "metric"',
+            'value_columns': ['metric']
+        }
+
+        jobs = {
+            'FIRST': dict(job),
+            'SECOND': dict(job, static_labels={'job': 'second'}),
+            'HOURLY': dict(job, interval_minutes=60),
+            'STREAMED': dict(job, fetch_size=100),
+            'TIMED': dict(job, query_timeout=30),
+            'TIMED_LABELED': dict(job, query_timeout='30', static_labels={'job': 'timed'}),
+            'TIMED_LONGER': dict(job, query_timeout=60)
+        }
+
+        job_list = build_job_list(jobs, ('API_', {}), ('DB_', {'TEST': {}}))
+
+        query_groups = {
+            job['id']: job.get('kwargs', {}).get('query_group') for job in job_list
+        }
+
+        self.assertEqual(query_groups['FIRST'], {
+            'name': 'FIRST',
+            'interval': 60,
+            'size': 2
+        })
+        self.assertEqual(query_groups['SECOND'], query_groups['FIRST'])
+        self.assertIsNone(query_groups['HOURLY'])
+        self.assertIsNone(query_groups['STREAMED'])
+
+        # Jobs with different query options never share a query
+        self.assertEqual(query_groups['TIMED'], {
+            'name': 'TIMED',
+            'interval': 60,
+            'size': 2
+        })
+        self.assertEqual(query_groups['TIMED_LABELED'], query_groups['TIMED'])
+        self.assertIsNone(query_groups['TIMED_LONGER'])
+
+    def test_build_job_list_reserved_id(self):
+        job = {
+            'services': ['DB_TEST'],
+            'interval_minutes': 1,
+            'statement': 'SELECT 1 AS "metric"',
+            'value_columns': ['metric']
+        }
+
+        with self.assertRaises(ValueError):
+            build_job_list({'all': dict(job)}, ('API_', {}), ('DB_', {'TEST': {}}))
+
+        job_list = build_job_list({'ALL': dict(job)}, ('API_', {}), ('DB_', {'TEST': {}}))
+
+        self.assertEqual(job_list[0]['id'], 'ALL')
+
+    def test_build_job_list_async_drivers(self):
+        job = {
+            'services': ['DB_ASYNC'],
+            'interval_minutes': 1,
+            'statement': 'SELECT 1 AS "metric"',
+            'value_columns': ['metric']
+        }
+
+        binds = {
+            'ASYNC': {'driver': 'asyncpg'},
+            'SYNC': {'driver': 'pg8000'}
+        }
+
+        # Jobs on async services are never grouped, since they run on the event loop thread
+        job_list = build_job_list({'FIRST': dict(job), 'SECOND': dict(job)}, ('API_', {}), ('DB_', binds))
+
+        self.assertFalse(any('query_group' in job.get('kwargs', {}).keys() for job in job_list))
+
+        with self.assertRaises(ValueError):
+            build_job_list({'MIXED': dict(job, services=['DB_ASYNC', 'DB_SYNC'])}, ('API_', {}), ('DB_', binds))
+
+    def test_build_job_list_incremental(self):
+        job = {
+            'services': ['DB_TEST'],
+            'interval_minutes': 1,
+            'statement': 'SELECT metric, ts FROM metrics WHERE ts > :last_timestamp',
+            'value_columns': ['metric'],
+            'timestamp_column': 'ts'
+        }
+
+        # Jobs querying from a point of their own never share their query
+        job_list = build_job_list({'FIRST': dict(job), 'SECOND': dict(job)}, ('API_', {}), ('DB_', {'TEST': {}}))
+
+        self.assertFalse(any('query_group' in job.get('kwargs', {}).keys() for job in job_list))
+
+        job.pop('timestamp_column')
+
+        with self.assertRaises(ValueError):
+            build_job_list({'FIRST': job}, ('API_', {}), ('DB_', {'TEST': {}}))
+
+    def test_build_job_list_dialect_options(self):
+        job = {
+            'services': ['DB_BQ'],
+            'interval_minutes': 1,
+            'statement': 'SELECT 1 AS metric',
+            'value_columns': ['metric'],
+            'maximum_bytes_billed': '1000000',
+            'use_bqstorage_api': 'true',
+            'use_query_cache': 'false'
+        }
+
+        binds = {
+            'BQ': {'dialect': 'bigquery'},
+            'PG': {'dialect': 'postgresql'}
+        }
+
+        job_list = build_job_list({'BQ': dict(job)}, ('API_', {}), ('DB_', binds))
+
+        self.assertTrue(job_list[0]['kwargs']['use_bqstorage_api'])
+        self.assertEqual(job_list[0]['kwargs']['execution_options'], {
+            'maximum_bytes_billed': 1000000,
+            'use_query_cache': False
+        })
+
+        with self.assertRaises(ValueError):
+            build_job_list({'PG': dict(job, services=['DB_PG'])}, ('API_', {}), ('DB_', binds))
+
+        job = {
+            'services': ['DB_ORACLE'],
+            'interval_minutes': 1,
+            'statement': 'SELECT 1 AS metric FROM dual',
+            'value_columns': ['metric'],
+            'arraysize': 5000,
+            'prefetchrows': '5001'
+        }
+
+        job_list = build_job_list({'ORACLE': dict(job)}, ('API_', {}), ('DB_', dict(binds, ORACLE={'dialect': 'oracle'})))
+
+        self.assertEqual(job_list[0]['kwargs']['execution_options'], {
+            'arraysize': 5000,
+            'prefetchrows': 5001
+        })
+
+        with self.assertRaises(ValueError):
+            build_job_list({'PG': dict(job, services=['DB_PG'])}, ('API_', {}), ('DB_', binds))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,13 +1,40 @@
-import json
+import asyncio
+import gzip
 import secrets
+import threading
+import time
 import unittest
 
-from datetime import datetime
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from timeit import default_timer
+
+import numpy
+import pytz
 
 from faker import Faker
 
-from ..base import BaseTestCase
-from metREx.app.main.service.metrics_service import db, Metrics, get_metric_info
+from sqlalchemy import create_engine
+
+from unittest import mock
+
+from ..base import BaseTestCase, get_sample_value
+from metREx.app.main.database import DatabaseAccessLayer, SharedConnections
+from metREx.app.main.database.oracle.dialect import OracleDialect
+from metREx.app.main import check_job_query_bytes, instrument_engine, job_statements, DB_CONNECT_PHASE_TIME, DB_CONNECT_TIME, TimeoutWarning
+from metREx.app.main.util.asyncio_helper import EventLoopThread
+from metREx.app.main.util.sample_helper import CollectorMetrics, MetricSamples
+from metREx.app.main.service.metrics_service import db, DB_POOL_CHECKED_OUT, DB_POOL_CHECKOUT_TIME, JOB_EXECUTION_TIME, JOB_FAILURES, JOB_QUERY_EXECUTIONS_SAVED, JOB_SERVICE_EXECUTION_TIME, JOB_SERVICE_FAILURES, JOB_STATEMENT_CACHE, Metrics, execute_job_statement, generate_latest, get_job_exposition, get_metric_info, get_registry, get_row_projector, iterate_record_batch_columns, iterate_row_batches, job_row_projectors, set_job_collector_metrics, shared_connections, to_label_column, to_timestamp_column, unset_job_collector_metrics
+
+
+def record_batch(*columns):
+    """Returns a stand-in for an Arrow record batch of the columns, whose arrays convert only as Arrow arrays do."""
+    arrays = [
+        mock.Mock(spec=['to_numpy', 'to_pylist'], **{'to_numpy.return_value': numpy.array(column, dtype=object), 'to_pylist.return_value': list(column)}) for column in columns
+    ]
+
+    return mock.Mock(num_rows=len(columns[0]), columns=arrays)
 
 
 class Metric(db.Model):
@@ -58,15 +85,581 @@ class TestDatabaseBlueprint(BaseTestCase):
 
                     self.assertIn(metric_name, database_metrics.keys())
 
-                    for json_label_data, info in database_metrics[metric_name].items():
-                        label_dict = json.loads(json_label_data)
+                    samples = database_metrics[metric_name]
+
+                    self.assertIsInstance(samples, MetricSamples)
+                    self.assertGreater(len(samples), 0)
+
+                    for label_values, metric_value, timestamp in samples:
+                        self.assertIsInstance(label_values, tuple)
+                        self.assertEqual(len(label_values), len(samples.label_names))
+                        self.assertIsInstance(metric_value, float)
+                        self.assertIsInstance(timestamp, float)
+
+    def test_get_database_metrics_streamed(self):
+        job_list = self.app.config.get('SCHEDULER_JOBS')
+
+        for i in range(2):
+            db.session.add(Metric(value=secrets.randbelow(255), label1=self.fake.word(), label2=self.fake.word()))
+
+        db.session.commit()
+
+        for job in job_list:
+            database_metrics = Metrics._get_database_metrics(*job['args'][1:])
+
+            streamed_metrics = Metrics._get_database_metrics(*job['args'][1:], fetch_size=2)
+
+            self.assertEqual(list(streamed_metrics.keys()), list(database_metrics.keys()))
+
+            for metric_name, samples in database_metrics.items():
+                self.assertEqual(streamed_metrics[metric_name].label_values, samples.label_values)
+                self.assertEqual(streamed_metrics[metric_name].values, samples.values)
+
+    def test_get_database_metrics_parallel(self):
+        service_names = {
+            'source': ['SHARD1', 'SHARD2', 'SHARD3'],
+            'push': []
+        }
+
+        def get_service_metrics(job_name, service_name, service_names, collector_metrics, *args):
+            # Later services finish first
+            time.sleep(0.01 * (3 - service_names['source'].index(service_name)))
+
+            if service_name == 'SHARD3':
+                raise ValueError('Shard unavailable.')
+
+            collector_metrics.add_sample('test.metric', ('shard',), ('all',), service_names['source'].index(service_name), 0.0)
+            collector_metrics.add_sample('test.metric', ('shard',), (service_name,), 1, 0.0)
+
+        with mock.patch.object(Metrics, '_get_database_service_metrics', side_effect=get_service_metrics):
+            failures = get_sample_value(JOB_SERVICE_FAILURES, 'metrex_job_service_failures_total', job='PARALLEL', service='SHARD3', exception='ValueError')
+
+            with self.assertRaises(ValueError):
+                Metrics._get_database_metrics('PARALLEL', service_names, '', [], parallelism=3)
+
+            self.assertEqual(get_sample_value(JOB_SERVICE_FAILURES, 'metrex_job_service_failures_total', job='PARALLEL', service='SHARD3', exception='ValueError'), failures + 1)
+
+            service_names['source'].pop()
+
+            database_metrics = Metrics._get_database_metrics('PARALLEL', service_names, '', [], parallelism=2)
+
+            self.assertEqual(list(database_metrics['test.metric']), [
+                (('all',), 0.0, 0.0),
+                (('SHARD1',), 1.0, 0.0),
+                (('SHARD2',), 1.0, 0.0)
+            ])
+
+    def test_get_database_metrics_async(self):
+        job_list = self.app.config.get('SCHEDULER_JOBS')
+
+        for job in job_list:
+            # Run on this thread's own loop, since the in-memory test database is only visible to this thread
+            database_metrics = asyncio.run(Metrics._get_database_metrics_async(*job['args'][1:]))
+
+            self.assertGreater(len(database_metrics), 0)
+
+            for metric_name, samples in Metrics._get_database_metrics(*job['args'][1:]).items():
+                self.assertEqual([label_values for label_values, *_ in database_metrics[metric_name]], [label_values for label_values, *_ in samples])
+
+    def test_run_database_job_async(self):
+        job_name = 'ASYNC'
+        job = mock.Mock(max_instances=1, next_run_time=None)
+        args = ('database', job_name, {'source': ['TEST'], 'push': []}, '', [])
+
+        async def get_database_metrics(*args, **kwargs):
+            collector_metrics = CollectorMetrics()
+            collector_metrics.add_sample('test.metric', ('label',), ('value',), 1, 0.0)
+
+            return collector_metrics
+
+        async def get_failed_database_metrics(*args, **kwargs):
+            raise ValueError('Statement failed.')
+
+        count = get_sample_value(JOB_EXECUTION_TIME, 'metrex_job_execution_seconds_count', job=job_name, category='database')
+
+        with mock.patch.object(Metrics, '_get_database_metrics_async', side_effect=get_database_metrics):
+            Metrics._run_database_job_async(job, args, {}).result(5)
+
+        self.assertIsNotNone(get_job_exposition(job_name))
+        self.assertEqual(get_sample_value(JOB_EXECUTION_TIME, 'metrex_job_execution_seconds_count', job=job_name, category='database'), count + 1)
+
+        failures = get_sample_value(JOB_FAILURES, 'metrex_job_failures_total', job=job_name, category='database', exception='ValueError')
+
+        with mock.patch.object(Metrics, '_get_database_metrics_async', side_effect=get_failed_database_metrics):
+            Metrics._run_database_job_async(job, args, {}).result(5)
+
+        self.assertIsNone(get_job_exposition(job_name))
+        self.assertEqual(get_sample_value(JOB_FAILURES, 'metrex_job_failures_total', job=job_name, category='database', exception='ValueError'), failures + 1)
+
+    def test_get_database_metrics_pool_observed(self):
+        job_list = self.app.config.get('SCHEDULER_JOBS')
+
+        for job in job_list:
+            for service_name in job['args'][2]['source']:
+                count = get_sample_value(DB_POOL_CHECKOUT_TIME, 'metrex_db_pool_checkout_seconds_count', service=service_name)
+                execution_count = get_sample_value(JOB_SERVICE_EXECUTION_TIME, 'metrex_job_service_execution_seconds_count', job=job['id'], service=service_name)
+                checked_out = get_sample_value(DB_POOL_CHECKED_OUT, 'metrex_db_pool_checked_out_connections', service=service_name)
+
+                Metrics._get_database_metrics(*job['args'][1:])
+
+                self.assertEqual(get_sample_value(DB_POOL_CHECKOUT_TIME, 'metrex_db_pool_checkout_seconds_count', service=service_name), count + 1)
+                self.assertEqual(get_sample_value(JOB_SERVICE_EXECUTION_TIME, 'metrex_job_service_execution_seconds_count', job=job['id'], service=service_name), execution_count + 1)
+                self.assertEqual(get_sample_value(DB_POOL_CHECKED_OUT, 'metrex_db_pool_checked_out_connections', service=service_name), checked_out)
+
+    def test_get_database_metrics_connection_shared(self):
+        job_list = self.app.config.get('SCHEDULER_JOBS')
+
+        def run(key, work, connect):
+            # The in-memory test database is only visible to this thread, so the work is run here
+            return work(connect())
+
+        for job in job_list:
+            service_name = job['args'][2]['source'][0]
+
+            engine = db.get_engine(bind=service_name)
+
+            engine.update_execution_options(share_connection=True)
+
+            try:
+                count = get_sample_value(JOB_SERVICE_EXECUTION_TIME, 'metrex_job_service_execution_seconds_count', job=job['id'], service=service_name)
+
+                with mock.patch.object(shared_connections, 'run', side_effect=run) as shared_run:
+                    database_metrics = Metrics._get_database_metrics(*job['args'][1:])
+            finally:
+                engine.update_execution_options(share_connection=False)
+
+            self.assertEqual(shared_run.call_count, len(job['args'][2]['source']))
+            self.assertEqual(get_sample_value(JOB_SERVICE_EXECUTION_TIME, 'metrex_job_service_execution_seconds_count', job=job['id'], service=service_name), count + 1)
+            self.assertEqual(list(database_metrics.keys()), list(Metrics._get_database_metrics(*job['args'][1:]).keys()))
+
+    def test_get_database_metrics_shared(self):
+        job_list = self.app.config.get('SCHEDULER_JOBS')
+
+        for job in job_list:
+            args = job['args'][2:]
+
+            query_group = {
+                'name': 'SHARED',
+                'interval': 60,
+                'size': 2
+            }
+
+            executions = get_sample_value(JOB_STATEMENT_CACHE, 'metrex_job_statement_cache_total', job='SHARED1', result='miss') + get_sample_value(JOB_STATEMENT_CACHE, 'metrex_job_statement_cache_total', job='SHARED1', result='hit')
+            saved = get_sample_value(JOB_QUERY_EXECUTIONS_SAVED, 'metrex_job_query_executions_saved_total', job='SHARED2')
+
+            database_metrics = Metrics._get_database_metrics('SHARED1', *args, query_group=query_group)
+            shared_metrics = Metrics._get_database_metrics('SHARED2', *args, query_group=query_group)
+
+            self.assertEqual(get_sample_value(JOB_QUERY_EXECUTIONS_SAVED, 'metrex_job_query_executions_saved_total', job='SHARED2'), saved + 1)
+            self.assertEqual(get_sample_value(JOB_STATEMENT_CACHE, 'metrex_job_statement_cache_total', job='SHARED2', result='miss'), 0)
+
+            for metric_name, samples in database_metrics.items():
+                self.assertEqual(list(shared_metrics[metric_name]), list(samples))
+
+            # The next run of either job executes the query again
+            Metrics._get_database_metrics('SHARED1', *args, query_group=query_group)
+
+            self.assertEqual(get_sample_value(JOB_STATEMENT_CACHE, 'metrex_job_statement_cache_total', job='SHARED1', result='miss') + get_sample_value(JOB_STATEMENT_CACHE, 'metrex_job_statement_cache_total', job='SHARED1', result='hit'), executions + 2)
+
+    def test_get_database_metrics_incremental(self):
+        job_name = 'INCREMENTAL'
+
+        service_names = {
+            'source': [self.bind],
+            'push': []
+        }
+
+        statement = 'SELECT id, value, ts FROM metrics WHERE ts > :last_timestamp'
+
+        # Limited to one series, which the series kept from earlier runs do not count towards
+        args = (job_name, service_names, statement, ['value'], (), 'ts', {self.bind: 'UTC'}, 1)
+
+        def get_last_timestamps():
+            return [call.args[7]['last_timestamp'] for call in execute.call_args_list]
+
+        first_ts = self.metric.ts
+
+        try:
+            with mock.patch('metREx.app.main.service.metrics_service.execute_job_statement', wraps=execute_job_statement) as execute:
+                set_job_collector_metrics(job_name, Metrics._get_database_metrics(*args), {})
+
+                db.session.add(Metric(value=1, ts=first_ts + timedelta(minutes=1)))
+                db.session.commit()
+
+                database_metrics = Metrics._get_database_metrics(*args)
+
+                set_job_collector_metrics(job_name, database_metrics, {})
+
+                # The watermark is the latest value of the timestamp column already collected
+                self.assertEqual(get_last_timestamps(), [datetime(1970, 1, 1), first_ts])
+                self.assertEqual(database_metrics.series_count, 1)
+                self.assertEqual(database_metrics.dropped_series_count, 0)
+                self.assertEqual(sorted(timestamp for label_values, value, timestamp in database_metrics['test.value']), [
+                    first_ts.replace(tzinfo=timezone.utc).timestamp(),
+                    (first_ts + timedelta(minutes=1)).replace(tzinfo=timezone.utc).timestamp()
+                ])
+
+                # Failed jobs query every row again on their next run
+                Metrics._handle_job_failure(job_name, 'database', RuntimeError('Failed'))
+
+                Metrics._get_database_metrics(*args)
+
+                self.assertEqual(get_last_timestamps()[-1], datetime(1970, 1, 1))
+
+            # Rows are rejected where the timestamp column is not a datetime, rather than given the time of the query
+            with self.assertRaises(ValueError):
+                Metrics._get_database_metrics(job_name, service_names, "SELECT value, 'not a timestamp' AS ts FROM metrics WHERE ts > :last_timestamp", ['value'], (), 'ts', {self.bind: 'UTC'})
+        finally:
+            unset_job_collector_metrics(job_name)
+
+    def test_get_database_metrics_statement_cached(self):
+        job_list = self.app.config.get('SCHEDULER_JOBS')
+
+        for job in job_list:
+            job_name = job['args'][1]
+
+            Metrics._get_database_metrics(*job['args'][1:])
+
+            hits = get_sample_value(JOB_STATEMENT_CACHE, 'metrex_job_statement_cache_total', job=job_name, result='hit')
+
+            Metrics._get_database_metrics(*job['args'][1:])
+
+            self.assertEqual(get_sample_value(JOB_STATEMENT_CACHE, 'metrex_job_statement_cache_total', job=job_name, result='hit'), hits + 1)
+
+    def test_transform_database_rows_limited(self):
+        service_names = {
+            'source': ['TEST'],
+            'push': []
+        }
+
+        rows = iter([(i, 'label %d' % i) for i in range(1000)])
+
+        collector_metrics = CollectorMetrics(max_series=10)
+
+        with mock.patch('metREx.app.main.service.metrics_service.transform_batch_size', 100):
+            Metrics._transform_database_rows('LIMITED', 'TEST', service_names, collector_metrics, ('metric', 'label'), iterate_row_batches(rows), 0.0, ['metric'])
+
+        self.assertEqual(collector_metrics.series_count, 10)
+
+        # Only the rows of the batch already fetched are counted as dropped, and no further rows are fetched
+        self.assertEqual(collector_metrics.dropped_series_count, 90)
+        self.assertEqual(next(rows), (100, 'label 100'))
+
+        Metrics._transform_database_rows('LIMITED', 'TEST', service_names, collector_metrics, ('metric', 'label'), iterate_row_batches(rows), 0.0, ['metric'])
+
+        self.assertEqual(collector_metrics.dropped_series_count, 90)
+        self.assertEqual(next(rows), (101, 'label 101'))
+
+        del job_row_projectors['LIMITED']
+
+    def test_transform_database_rows_columnar(self):
+        service_names = {
+            'source': ['TEST'],
+            'push': []
+        }
+
+        columns = ('metric', 'other', 'label', 'ts')
+
+        rows = [
+            (Decimal('1.5'), 2, 'a', datetime(2021, 1, 1)),
+            (None, 3, 'b', datetime(2021, 7, 1)),
+            (4, 5, 'a', datetime(2021, 1, 1, tzinfo=timezone.utc))
+        ]
+
+        timezones = {
+            'TEST': 'America/New_York'
+        }
+
+        columnar_metrics = CollectorMetrics()
+        row_metrics = CollectorMetrics(max_label_values=10)
+
+        # Unlimited samples are converted column by column, and limited ones row by row
+        for collector_metrics in [columnar_metrics, row_metrics]:
+            Metrics._transform_database_rows('COLUMNAR', 'TEST', service_names, collector_metrics, columns, iterate_row_batches(rows), 0.0, ['metric', 'other'], [('static', 'value')], 'ts', timezones)
+
+        # Arrow record batches are converted from their columns, either way
+        batches = [
+            record_batch(*zip(*rows[:2])),
+            record_batch(*zip(*rows[2:]))
+        ]
+
+        for collector_metrics in [CollectorMetrics(), CollectorMetrics(max_label_values=10)]:
+            Metrics._transform_database_rows('COLUMNAR', 'TEST', service_names, collector_metrics, columns, iterate_record_batch_columns(batches), 0.0, ['metric', 'other'], [('static', 'value')], 'ts', timezones)
+
+            self.assertEqual(str(list(collector_metrics['test.metric'])), str(list(columnar_metrics['test.metric'])))
+
+        self.assertEqual(list(columnar_metrics.keys()), list(row_metrics.keys()))
+
+        for metric_name, samples in columnar_metrics.items():
+            self.assertEqual(samples.label_names, row_metrics[metric_name].label_names)
+            self.assertEqual(str(list(samples)), str(list(row_metrics[metric_name])))
+
+        # Naive timestamps are localized to the service's timezone, and duplicate series are added once
+        self.assertEqual(list(columnar_metrics['test.metric'])[0][2], datetime(2021, 1, 1, 5, tzinfo=timezone.utc).timestamp())
+        self.assertEqual(list(columnar_metrics['test.metric'])[1][2], datetime(2021, 7, 1, 4, tzinfo=timezone.utc).timestamp())
+        self.assertEqual(columnar_metrics.series_count, 4)
+
+        del job_row_projectors['COLUMNAR']
+
+    def test_query_timeout_limited(self):
+        engine = db.get_engine(bind=self.bind)
+
+        engine.update_execution_options(query_timeout=30)
+
+        dal = DatabaseAccessLayer(db)
+
+        try:
+            dal.init_db(self.bind)
+
+            # The limit lowers, but never raises, the timeout of the job or the service
+            for timeout, max_timeout, expected_timeout in [(None, 10, 10), (None, 60, 30), (5, 10, 5), (20, 10, 10)]:
+                result = dal.execute('SELECT 1', timeout=timeout, max_timeout=max_timeout)
+
+                self.assertEqual(result.context.execution_options['query_timeout'], expected_timeout)
+
+                result.close()
+        finally:
+            dal.close()
+
+            engine.update_execution_options(query_timeout=None)
+
+        self.assertFalse(dal.supports_query_timeout(self.bind))
+
+    def test_query_deadline(self):
+        dal = DatabaseAccessLayer(db)
+
+        try:
+            dal.init_db(self.bind)
+
+            # Each query is given only the time left before the job's deadline
+            result = execute_job_statement(dal, 'DEADLINE', 'SELECT 1', query_timeout=60, query_deadline=default_timer() + 10)
+
+            self.assertGreater(result.context.execution_options['query_timeout'], 9)
+            self.assertLessEqual(result.context.execution_options['query_timeout'], 10)
+
+            result.close()
+
+            with self.assertRaises(TimeoutWarning):
+                execute_job_statement(dal, 'DEADLINE', 'SELECT 1', query_deadline=default_timer() - 1)
+        finally:
+            dal.close()
+
+            job_statements.pop('DEADLINE', None)
+
+    def test_query_timeout_mariadb(self):
+        connection = mock.Mock(info={})
+        connection.engine.url.get_backend_name.return_value = 'mysql'
+
+        dal = DatabaseAccessLayer(db)
+        dal._session = mock.Mock(**{'connection.return_value': connection})
+
+        for is_mariadb, expected_statement in [(True, 'SET SESSION max_statement_time = 2.500'), (False, 'SET SESSION max_execution_time = 2500')]:
+            connection.info.clear()
+            connection.dialect._is_mariadb = is_mariadb
+
+            dal._set_query_timeout(2.5)
+
+            connection.exec_driver_sql.assert_called_with(expected_statement)
 
-                        self.assertIsInstance(label_dict, dict)
-                        self.assertIsInstance(info, tuple)
+    def test_record_batch_columns(self):
+        batches = [
+            record_batch([1, 2], ['a', 'b']),
+            record_batch([3], ['c'])
+        ]
 
-                        metric_value = info[0]
+        self.assertEqual([(row_count, rows, len(columns)) for row_count, rows, columns in iterate_record_batch_columns(batches)], [(2, None, 2), (1, None, 2)])
 
-                        self.assertIsInstance(metric_value, int)
+        dal = DatabaseAccessLayer(db)
+
+        try:
+            dal.init_db(self.bind)
+
+            result = dal.execute('SELECT 1')
+
+            with self.assertRaises(ValueError):
+                dal.get_record_batches(result)
+
+            result.close()
+        finally:
+            dal.close()
+
+    def test_check_job_query_bytes(self):
+        job = {
+            'id': 'BQ',
+            'args': ['database', 'BQ', {'source': ['BQ', 'TEST'], 'push': []}, 'SELECT 1 AS metric', ['metric']],
+            'kwargs': {'execution_options': {'maximum_bytes_billed': 1000}}
+        }
+
+        binds = dict(self.app.config['SQLALCHEMY_BINDS'], BQ='bigquery://project')
+
+        with mock.patch.dict(self.app.config, {'SQLALCHEMY_BINDS': binds}):
+            with mock.patch.object(DatabaseAccessLayer, 'get_estimated_bytes', return_value=1000) as get_estimated_bytes:
+                check_job_query_bytes(self.app, [job])
+
+                # Only queries on BigQuery services are estimated
+                get_estimated_bytes.assert_called_once_with('BQ', 'SELECT 1 AS metric', None)
+
+                get_estimated_bytes.return_value = 1001
+
+                with self.assertRaises(ValueError):
+                    check_job_query_bytes(self.app, [job])
+
+                # Jobs are kept where the estimate itself fails
+                get_estimated_bytes.side_effect = RuntimeError('Service unavailable')
+
+                check_job_query_bytes(self.app, [job])
+
+                get_estimated_bytes.reset_mock(side_effect=True)
+
+                get_estimated_bytes.return_value = 1000
+
+                job['args'][3] = 'SELECT 1 AS metric WHERE CURRENT_TIMESTAMP() > :last_timestamp'
+
+                check_job_query_bytes(self.app, [job])
+
+                get_estimated_bytes.assert_called_once_with('BQ', job['args'][3], {'last_timestamp': datetime(1970, 1, 1)})
+
+        dal = DatabaseAccessLayer(db)
+
+        try:
+            dal.init_db(self.bind)
+
+            # Statements are compiled and their parameters bound before the dialect estimates them
+            with mock.patch.object(db.get_engine(bind=self.bind).dialect, 'get_estimated_bytes', create=True, return_value=1) as get_estimated_bytes:
+                self.assertEqual(dal.get_estimated_bytes(self.bind, 'SELECT :last_timestamp AS ts', {'last_timestamp': datetime(1970, 1, 1)}), 1)
+
+                self.assertEqual(get_estimated_bytes.call_args[0][1:], ('SELECT ? AS ts', (datetime(1970, 1, 1),)))
+        finally:
+            dal.close()
+
+        dal = DatabaseAccessLayer(db)
+
+        try:
+            dal.init_db(self.bind)
+
+            result = dal.execute('SELECT 1', execution_options={'use_query_cache': False})
+
+            self.assertFalse(result.context.execution_options['use_query_cache'])
+
+            result.close()
+        finally:
+            dal.close()
+
+    def test_column_conversion(self):
+        labels = to_label_column(['a', None, 'a', 'b'])
+
+        self.assertEqual(labels, ['a', '', 'a', 'b'])
+        self.assertIs(labels[0], labels[2])
+
+        # Values other than strings are converted one by one, since equal values may have different labels
+        self.assertEqual(to_label_column([Decimal('1.0'), Decimal('1.00'), 2]), ['1.0', '1.00', '2'])
+
+        tzinfo = pytz.timezone('America/New_York')
+
+        timestamps = to_timestamp_column([datetime(2021, 1, 1), datetime(2021, 7, 1), datetime(2021, 1, 1), datetime(2021, 1, 1, tzinfo=timezone.utc)], tzinfo, 0.0)
+
+        self.assertEqual(timestamps.tolist(), [
+            datetime(2021, 1, 1, 5, tzinfo=timezone.utc).timestamp(),
+            datetime(2021, 7, 1, 4, tzinfo=timezone.utc).timestamp(),
+            datetime(2021, 1, 1, 5, tzinfo=timezone.utc).timestamp(),
+            datetime(2021, 1, 1, tzinfo=timezone.utc).timestamp()
+        ])
+
+    def test_get_row_projector(self):
+        projector = get_row_projector('TEST', ('Metric', 'Label 1', 'TS'), 'test', ['metric'], [('Static', 'test'), ('label_1', 'other')], 'ts', 'host')
+
+        self.assertEqual(projector.metric_indexes, (('test.metric', 0),))
+        self.assertEqual(projector.timestamp_index, 2)
+        self.assertEqual(projector.label_names, ('instance', 'label_1', 'static'))
+        self.assertEqual(projector.get_label_values((1, None, 0)), ('host', '', 'test'))
+
+        self.assertIs(get_row_projector('TEST', ('Metric', 'Label 1', 'TS'), 'test', ['metric'], [('Static', 'test'), ('label_1', 'other')], 'ts', 'host'), projector)
+
+        with self.assertRaises(ValueError):
+            get_row_projector('TEST', ('Label 1', 'TS'), 'test', ['metric'])
+
+        del job_row_projectors['TEST']
+
+    def test_job_exposition_cached(self):
+        job_list = self.app.config.get('SCHEDULER_JOBS')
+
+        for job in job_list:
+            job_name = job['args'][1]
+
+            database_metrics = Metrics._get_database_metrics(*job['args'][1:])
+
+            set_job_collector_metrics(job_name, database_metrics, {})
+
+            exposition = get_job_exposition(job_name)
+
+            self.assertIsInstance(exposition.render(), bytes)
+            self.assertEqual(exposition.render(), generate_latest(get_registry(job_name)))
+
+            unset_job_collector_metrics(job_name)
+
+            self.assertIsNone(get_job_exposition(job_name))
+
+    def test_all_job_metrics_filtered(self):
+        job_list = self.app.config.get('SCHEDULER_JOBS')
+
+        for job in job_list:
+            job_name = job['args'][1]
+
+            database_metrics = Metrics._get_database_metrics(*job['args'][1:])
+
+            set_job_collector_metrics(job_name, database_metrics, {})
+
+        with self.client:
+            response = self.client.get('/metrics/all?category=database&label=static:test')
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, b''.join([get_job_exposition(job['id']).render() for job in job_list]))
+
+            response = self.client.get('/metrics/all?label=static:other')
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, b'')
+
+            response = self.client.get('/metrics/all?label=static')
+
+            self.assertEqual(response.status_code, 400)
+
+        for job in job_list:
+            unset_job_collector_metrics(job['id'])
+
+    def test_job_exposition_streamed(self):
+        self.app.config['EXPOSITION_STREAMING_MIN_SERIES'] = 1
+        self.app.config['EXPOSITION_CHUNK_SIZE'] = 16
+
+        job_list = self.app.config.get('SCHEDULER_JOBS')
+
+        for job in job_list:
+            job_name = job['args'][1]
+
+            database_metrics = Metrics._get_database_metrics(*job['args'][1:])
+
+            set_job_collector_metrics(job_name, database_metrics, {})
+
+            self.assertTrue(get_job_exposition(job_name).streaming)
+
+            with self.client:
+                response = self.client.get('/metrics/' + job_name)
+
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.data, generate_latest(get_registry(job_name)))
+
+                response = self.client.get('/metrics/' + job_name, headers={'Accept-Encoding': 'gzip'})
+
+                self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+                self.assertEqual(gzip.decompress(response.data), generate_latest(get_registry(job_name)))
+
+                # Protobuf metric families are encoded whole, so streamed jobs are served as text instead
+                for path in ['/metrics/' + job_name, '/metrics/all']:
+                    response = self.client.get(path, headers={'Accept': 'application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;encoding=delimited;q=0.7,text/plain;version=0.0.4;q=0.3'})
+
+                    self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+
+            unset_job_collector_metrics(job_name)
 
     def test_metric_created(self):
         if self.metric is not None:
@@ -98,5 +691,178 @@ class TestDatabaseBlueprint(BaseTestCase):
             db.drop_all(bind=self.bind)
 
 
+class TestConnectPhases(unittest.TestCase):
+    def test_connect_phases_observed(self):
+        engine = create_engine('sqlite://')
+
+        instrument_engine(engine, 'PHASES')
+
+        counts = [
+            get_sample_value(DB_CONNECT_TIME, 'metrex_db_connect_seconds_count', service='PHASES')
+        ] + [
+            get_sample_value(DB_CONNECT_PHASE_TIME, 'metrex_db_connect_phase_seconds_count', service='PHASES', phase=phase) for phase in ['driver', 'setup']
+        ]
+
+        with engine.connect() as connection:
+            self.assertEqual(connection.exec_driver_sql('SELECT 1').scalar(), 1)
+
+        self.assertEqual([
+            get_sample_value(DB_CONNECT_TIME, 'metrex_db_connect_seconds_count', service='PHASES')
+        ] + [
+            get_sample_value(DB_CONNECT_PHASE_TIME, 'metrex_db_connect_phase_seconds_count', service='PHASES', phase=phase) for phase in ['driver', 'setup']
+        ], [count + 1 for count in counts])
+
+        engine.dispose()
+
+
+class TestOracleDialect(unittest.TestCase):
+    def test_connect(self):
+        dialect = OracleDialect(session_pool={'min': 1, 'max': 4, 'increment': 1}, drcp_connection_class='METREX')
+        dialect.dbapi = mock.Mock()
+
+        cparams = {
+            'user': 'user',
+            'password': 'password',
+            'dsn': 'dsn'
+        }
+
+        for i in range(2):
+            connection = dialect.connect(**cparams)
+
+        # One session pool is created for the engine, from which each connection is acquired
+        dialect.dbapi.SessionPool.assert_called_once_with(threaded=True, min=1, max=4, increment=1, **cparams)
+        dialect.dbapi.SessionPool.return_value.acquire.assert_called_with(cclass='METREX', purity=dialect.dbapi.ATTR_PURITY_SELF)
+
+        self.assertIs(connection, dialect.dbapi.SessionPool.return_value.acquire.return_value)
+
+        # Without a session pool, each connection is opened with the connection class
+        dialect = OracleDialect(drcp_connection_class='METREX')
+        dialect.dbapi = mock.Mock()
+
+        connection = dialect.connect(**cparams)
+
+        dialect.dbapi.connect.assert_called_once_with(cclass='METREX', purity=dialect.dbapi.ATTR_PURITY_SELF, **cparams)
+        dialect.dbapi.SessionPool.assert_not_called()
+
+        self.assertIs(connection, dialect.dbapi.connect.return_value)
+
+    def test_do_execute(self):
+        dialect = OracleDialect()
+
+        cursor = mock.Mock()
+        context = mock.Mock(execution_options={'arraysize': 5000, 'prefetchrows': 5001})
+
+        dialect.do_execute(cursor, 'SELECT 1 FROM dual', {}, context)
+
+        self.assertEqual((cursor.arraysize, cursor.prefetchrows), (5000, 5001))
+
+        cursor.execute.assert_called_once_with('SELECT 1 FROM dual', {})
+
+
+class TestEventLoopThread(unittest.TestCase):
+    def test_submit(self):
+        event_loop = EventLoopThread()
+
+        released = threading.Event()
+
+        async def wait():
+            await asyncio.get_running_loop().run_in_executor(None, released.wait, 5)
+
+            return 'done'
+
+        future = event_loop.submit(wait(), 'TEST')
+
+        self.assertEqual(event_loop.get_running_count('TEST'), 1)
+
+        released.set()
+
+        self.assertEqual(future.result(5), 'done')
+        self.assertEqual(event_loop.get_running_count('TEST'), 0)
+
+
+class TestSharedConnections(unittest.TestCase):
+    def test_run(self):
+        shared_connections = SharedConnections()
+
+        connections = []
+        queued = threading.Semaphore(0)
+        started = threading.Event()
+        released = threading.Event()
+        finished = threading.Event()
+        closed = threading.Event()
+        results = {}
+
+        class QueuedFuture(Future):
+            def result(self, timeout=None):
+                # Only waited on once the work is queued
+                queued.release()
+
+                return super(QueuedFuture, self).result(timeout)
+
+        def connect():
+            connection = mock.Mock(invalidated=False)
+            connection.close.side_effect = closed.set
+
+            connections.append(connection)
+
+            return connection
+
+        def work(name):
+            def _work(connection):
+                if name == 'FIRST':
+                    started.set()
+                    released.wait(5)
+                elif name == 'FAILED':
+                    raise ValueError('Statement failed.')
+                elif name == 'LAST':
+                    finished.wait(5)
+
+                return name, connection
+
+            return _work
+
+        def run(name):
+            try:
+                results[name] = shared_connections.run('TEST', work(name), connect)
+            except ValueError as e:
+                results[name] = e
+
+        threads = [threading.Thread(target=run, args=(name,)) for name in ['FIRST', 'FAILED', 'LAST']]
+
+        with mock.patch('metREx.app.main.database.Future', QueuedFuture):
+            threads[0].start()
+
+            started.wait(5)
+
+            # Jobs arriving while the first one's work runs are queued for the same connection
+            for thread in threads[1:]:
+                thread.start()
+
+            for thread in threads:
+                queued.acquire(timeout=5)
+
+            released.set()
+
+            # The first job returns once its own work is done, while the work of the others is still running
+            threads[0].join(5)
+
+            self.assertEqual(results['FIRST'], ('FIRST', connections[0]))
+            self.assertNotIn('LAST', results.keys())
+
+            finished.set()
+
+            for thread in threads[1:]:
+                thread.join(5)
+
+        self.assertTrue(closed.wait(5))
+        self.assertEqual(len(connections), 1)
+        self.assertEqual(results['LAST'], ('LAST', connections[0]))
+        self.assertIsInstance(results['FAILED'], ValueError)
+
+        connections[0].close.assert_called_once_with()
+
+        self.assertEqual(shared_connections.run('TEST', work('NEXT'), connect), ('NEXT', connections[1]))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,79 @@
+import hashlib
+import shutil
+import tempfile
+import unittest
+import weakref
+
+from flask import Flask
+
+from unittest import mock
+
+from metREx.app.main.controller.metrics_controller import format_exposition_response
+from metREx.app.main.util.mmap_helper import ResultStore, StoredExposition
+
+
+class TestResultStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.result_store = ResultStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_write_and_read(self):
+        chunks = [b'# HELP test_metric \n', b'# TYPE test_metric gauge\n', b'test_metric{job="a/b"} 1.0\n']
+
+        self.result_store.write('a/b', chunks, {'job': 'a/b'})
+
+        exposition = self.result_store.read('a/b')
+
+        data = b''.join(chunks)
+
+        self.assertEqual(exposition.render(), data)
+        self.assertEqual(b''.join(exposition.stream(chunk_size=7)), data)
+        self.assertEqual(exposition.get_etag(), hashlib.sha256(data).hexdigest())
+        self.assertEqual(exposition.get_constant_labels(), {'job': 'a/b'})
+
+        with exposition.open() as f:
+            self.assertEqual(f.read(), data)
+
+        self.assertIs(self.result_store.read('a/b'), exposition)
+
+    def test_replace_and_delete(self):
+        self.result_store.write('test', [b'old\n'], {})
+
+        exposition = self.result_store.read('test')
+
+        self.result_store.write('test', [b'new\n'], {})
+
+        # Readers holding the previous mapping are unaffected by the replacement
+        self.assertEqual(exposition.render(), b'old\n')
+        self.assertEqual(self.result_store.read('test').render(), b'new\n')
+
+        reference = weakref.ref(self.result_store.read('test'))
+
+        self.result_store.delete('test')
+
+        self.assertIsNone(self.result_store.read('test'))
+
+        # The mapping of the deleted file is no longer held
+        self.assertIsNone(reference())
+
+    def test_not_modified(self):
+        self.result_store.write('test', [b'test_metric 1.0\n'], {})
+
+        exposition = self.result_store.read('test')
+
+        app = Flask(__name__)
+
+        with app.test_request_context(headers={'If-None-Match': '"' + exposition.get_etag() + '"'}):
+            with mock.patch.object(StoredExposition, 'open') as open_file:
+                response = format_exposition_response(exposition, exposition.formats)
+
+        self.assertEqual(response.status_code, 304)
+
+        open_file.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import unittest
+
+from metREx.app.main.util.sample_helper import CollectorMetrics, MetricSamples, TextLineCache
+
+
+def build_collector_metrics(samples):
+    collector_metrics = CollectorMetrics()
+
+    for label_values, value in samples:
+        collector_metrics.add_sample('test.metric', ('label1', 'label2'), label_values, value, 1.5)
+
+    return collector_metrics
+
+
+class TestCollectorMetrics(unittest.TestCase):
+    label_names = ('label1', 'label2')
+
+    def test_add_sample(self):
+        collector_metrics = CollectorMetrics()
+
+        self.assertTrue(collector_metrics.add_sample('test.metric', self.label_names, ('a', 1), 10, 0.0))
+        self.assertFalse(collector_metrics.add_sample('test.metric', self.label_names, ('a', '1'), 20, 0.0))
+
+        samples = collector_metrics['test.metric']
+
+        self.assertIsInstance(samples, MetricSamples)
+        self.assertEqual(samples.label_names, self.label_names)
+        self.assertEqual(list(samples), [(('a', '1'), 10.0, 0.0)])
+        self.assertEqual(collector_metrics.series_count, 1)
+        self.assertEqual(collector_metrics.dropped_series_count, 0)
+
+    def test_max_series(self):
+        collector_metrics = CollectorMetrics(max_series=2)
+
+        for i in range(5):
+            collector_metrics.add_sample('test.metric', self.label_names, ('a', str(i)), i, 0.0)
+
+        self.assertTrue(collector_metrics.is_full)
+        self.assertEqual(len(collector_metrics['test.metric']), 2)
+        self.assertEqual(collector_metrics.dropped_series_count, 3)
+
+    def test_max_label_values(self):
+        collector_metrics = CollectorMetrics(max_label_values=2)
+
+        for i in range(5):
+            collector_metrics.add_sample('test.metric', self.label_names, ('a', str(i)), i, 0.0)
+
+        collector_metrics.add_sample('other.metric', self.label_names, ('a', '1'), 1, 0.0)
+
+        self.assertFalse(collector_metrics.is_full)
+        self.assertEqual(len(collector_metrics['test.metric']), 2)
+        self.assertEqual(len(collector_metrics['other.metric']), 1)
+        self.assertEqual(collector_metrics.dropped_series_count, 3)
+
+    def test_merge(self):
+        collector_metrics = build_collector_metrics([(('a', 'x'), 1), (('b', 'x'), 2)])
+        collector_metrics.max_series = 3
+
+        collector_metrics.merge(build_collector_metrics([(('b', 'x'), 20), (('c', 'x'), 3), (('d', 'x'), 4)]))
+
+        self.assertEqual(list(collector_metrics['test.metric']), [
+            (('a', 'x'), 1.0, 1.5),
+            (('b', 'x'), 2.0, 1.5),
+            (('c', 'x'), 3.0, 1.5)
+        ])
+        self.assertEqual(collector_metrics.dropped_series_count, 1)
+
+    def test_keep_sample(self):
+        collector_metrics = CollectorMetrics(max_series=1)
+
+        collector_metrics.add_sample('test.metric', self.label_names, ('a', 'x'), 1, 0.0)
+
+        # Kept samples are added beyond the limits, unless their series was collected again
+        self.assertTrue(collector_metrics.keep_sample('test.metric', self.label_names, ('b', 'x'), 2, 0.0))
+        self.assertFalse(collector_metrics.keep_sample('test.metric', self.label_names, ('a', 'x'), 10, 0.0))
+
+        self.assertEqual(len(collector_metrics['test.metric']), 2)
+        self.assertEqual(collector_metrics.series_count, 1)
+        self.assertEqual(collector_metrics.dropped_series_count, 0)
+
+        merged_metrics = CollectorMetrics(max_series=1)
+        merged_metrics.merge(collector_metrics)
+
+        self.assertEqual(len(merged_metrics['test.metric']), 2)
+        self.assertEqual(merged_metrics.dropped_series_count, 0)
+
+
+class TestTextLineCache(unittest.TestCase):
+    def test_render(self):
+        text_line_cache = TextLineCache()
+
+        data, changed_count = text_line_cache.render(build_collector_metrics([
+            (('b', 'x'), 1),
+            (('a', 'y\n"z"'), 2),
+            (('c', 'z'), 3)
+        ]), True)
+
+        self.assertEqual(changed_count, 3)
+        self.assertEqual(data, (
+            b'# HELP test_metric \n'
+            b'# TYPE test_metric gauge\n'
+            b'test_metric{label1="b",label2="x"} 1.0 1500\n'
+            b'test_metric{label1="a",label2="y\\n\\"z\\""} 2.0 1500\n'
+            b'test_metric{label1="c",label2="z"} 3.0 1500\n'
+        ))
+
+        collector_metrics = build_collector_metrics([
+            (('b', 'x'), 1),
+            (('a', 'y\n"z"'), 5),
+            (('d', 'z'), 3)
+        ])
+
+        data, changed_count = text_line_cache.render(collector_metrics, True)
+
+        self.assertEqual(changed_count, 3)
+        self.assertEqual(data, TextLineCache().render(collector_metrics, True)[0])
+
+        data, changed_count = text_line_cache.render(collector_metrics, True)
+
+        self.assertEqual(changed_count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()